@@ -1,29 +1,1118 @@
 import os
-from flask import Flask, render_template, request, send_file, jsonify, abort
+from flask import Flask, render_template, request, send_file, jsonify, abort, url_for, Response
 from markupsafe import Markup
 import requests
+from requests.adapters import HTTPAdapter
 from openpyxl import Workbook
 from openpyxl.worksheet.table import Table, TableStyleInfo
 from openpyxl.styles import Font, PatternFill, Alignment  # Добавим импорт в начало файла
 from openpyxl.worksheet.hyperlink import Hyperlink  # Обновленный импорт
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.utils import get_column_letter
 from datetime import datetime, timedelta
 import json
+import re
+import logging
 import threading
 import math
+import bisect
+import numpy as np
+import itertools
+import warnings
+import time
+import hashlib
+import sqlite3
+import uuid
+import tempfile
+import ast
+import csv
+import io
+from collections import OrderedDict, deque
+from dataclasses import dataclass, replace
+from contextlib import contextmanager, ExitStack
+from functools import partial
+from urllib.parse import urlsplit
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import fcntl  # Блокировки заданий между процессами; на Windows приложение работает одним процессом
+except ImportError:
+    fcntl = None
 
 app = Flask(__name__)
 
-print(os.getcwd())
+# Уровень журнала: INFO - этапы отчетов и заданий, DEBUG - также каждый запрос и каждый товар
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+logging.basicConfig(level=LOG_LEVEL, format='%(asctime)s %(levelname)s [%(threadName)s] %(message)s')
+logger = logging.getLogger('analyse')
+
+# Каталог приложения: config.py ищется рядом с app.py, а не в текущем каталоге процесса
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+# Каталог локальных данных (базы SQLite, готовые отчеты), общий для всех воркеров WSGI-сервера
+DATA_DIR = os.environ.get('ANALYSE_DATA_DIR', APP_DIR)
 
-# Загрузка токена из файла конфигурации
-with open('config.py', 'r') as config_file:
-    exec(config_file.read())
+def load_token():
+    # Токен API МойСклад: переменная окружения MOYSKLAD_TOKEN или присваивание MOYSKLAD_TOKEN в config.py.
+    # Файл конфигурации разбирается, а не выполняется
+    token = os.environ.get('MOYSKLAD_TOKEN')
+    if token:
+        return token
+    config_path = os.path.join(APP_DIR, 'config.py')
+    with open(config_path, 'r', encoding='utf-8') as config_file:
+        tree = ast.parse(config_file.read(), config_path)
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and any(isinstance(target, ast.Name) and target.id == 'MOYSKLAD_TOKEN'
+                                                for target in node.targets):
+            return ast.literal_eval(node.value)
+    raise RuntimeError(f"Не задан токен МойСклад: переменная окружения MOYSKLAD_TOKEN или MOYSKLAD_TOKEN в {config_path}")
+
+MOYSKLAD_TOKEN = load_token()
 
 BASE_URL = 'https://api.moysklad.ru/api/remap/1.2'
+API_PATH = urlsplit(BASE_URL).path
+UUID_PATTERN = re.compile(r'[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}')
+
+# Начало истории операций для расчета скорости продаж
+SALES_HISTORY_START = "2024-01-01 00:00:00"
+# Размер страницы при пакетной загрузке оборотов (максимум API - 1000)
+TURNOVER_PAGE_LIMIT = 1000
+# Локальное хранилище операций по складам: из API догружаются только операции новее отметки синхронизации
+TURNOVER_DB_FILE = os.path.join(DATA_DIR, 'turnover.sqlite3')
+# Сколько последних часов перед отметкой загружать заново: документы задним числом и расхождение часов
+TURNOVER_RESYNC_HOURS = 48
+# Точность количества при пакетном расчете скорости продаж (МойСклад хранит до 4 знаков после запятой)
+QUANTITY_SCALE = 10 ** 4
+# Сутки в микросекундах - единицах времени дневных итогов оборотов
+DAY_US = 24 * 60 * 60 * 10 ** 6
+# Как часто (в секундах) фоновое задание догружает операции и дневные итоги складов (None - не обновлять)
+TURNOVER_REFRESH_INTERVAL = 30 * 60
+
+# Потоковая запись Excel (write_only): строки пишутся один раз, память не растет с размером отчета
+EXCEL_STREAMING = True
+# Отчет для прямой выдачи в ответ держится в памяти до этого размера, больший сбрасывается во временный файл
+EXCEL_SPOOL_MAX_SIZE = 32 * 1024 * 1024
+XLSX_MIMETYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+# Границы корзин гистограммы времени ответа МойСклад для /metrics, в секундах
+HTTP_LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# Ограничения API МойСклад: не более 5 параллельных запросов от одного пользователя
+MOYSKLAD_MAX_WORKERS = 5
+# Сколько раз повторять запрос при 429/503 и сетевых ошибках
+MOYSKLAD_MAX_RETRIES = 5
+MOYSKLAD_TIMEOUT = 120
+
+# Время жизни кэша справочников (склады, дерево групп товаров), в секундах
+REFERENCE_CACHE_TTL = 15 * 60
+# База кэша справочников, общая для воркеров WSGI-сервера и перезапусков процесса (None - только в памяти):
+# справочник загружает из API один процесс, остальные берут его из базы
+REFERENCE_CACHE_FILE = os.path.join(DATA_DIR, 'reference_cache.sqlite3')
+# Как часто (в секундах) процесс сверяет свою копию справочника с базой, чтобы заметить сброс или обновление
+REFERENCE_CACHE_SYNC_INTERVAL = 10
+# Сколько секунд процесс ждет, пока справочник загружает другой процесс
+REFERENCE_CACHE_LOCK_TIMEOUT = 300
+
+# Кэш результатов отчета (данные товаров со скоростью продаж) для одинаковых складов, периода и групп:
+# время жизни в секундах, число отчетов и общее число строк, после которых вытесняются давно не использованные
+REPORT_CACHE_TTL = 10 * 60
+REPORT_CACHE_MAX_ENTRIES = 16
+REPORT_CACHE_MAX_ROWS = 500000
+
+# Раскладка отчета по нескольким складам: 'columns' - скорость, прогноз и минимальный остаток каждого склада
+# в соседних столбцах одного листа, 'sheets' - отдельный лист на каждый склад
+STORE_LAYOUTS = ('columns', 'sheets')
+# Разбиение отчета на листы по группам товаров: 'none' - без разбиения, 'level1' - лист на каждую корневую группу,
+# 'level2' - на каждую группу второго уровня
+GROUP_SPLITS = ('none', 'level1', 'level2')
+
+# Наибольшее число групп в одном ответе /api/folders
+FOLDER_PAGE_LIMIT = 1000
+# Форматы выгрузки /api/report и наибольшее число строк в одной странице JSON
+REPORT_EXPORT_FORMATS = ('json', 'csv', 'parquet')
+REPORT_PAGE_LIMIT = 5000
+# Сколько строк CSV собирается в один фрагмент потокового ответа
+CSV_CHUNK_ROWS = 1000
+
+# Фоновые задания формирования отчетов: база состояния, каталог готовых файлов и число воркеров
+JOBS_DB_FILE = os.path.join(DATA_DIR, 'jobs.sqlite3')
+JOBS_RESULTS_DIR = os.path.join(DATA_DIR, 'reports')
+# Файлы блокировок заданий: задание выполняет только захвативший блокировку процесс (воркер)
+JOBS_LOCK_DIR = os.path.join(DATA_DIR, 'job_locks')
+REPORT_WORKERS = 2
+# Хранение готовых файлов заданий: максимальный возраст в секундах и общий размер каталога в байтах
+JOBS_RESULTS_MAX_AGE = 24 * 60 * 60
+JOBS_RESULTS_MAX_BYTES = 500 * 1024 * 1024
+# Как часто (в секундах) записывать прогресс задания в базу
+JOB_PROGRESS_INTERVAL = 1.0
+
+# Постоянные отчеты, которые формируются по расписанию (см. load_standing_reports): файл настроек рядом с app.py,
+# каталог готовых книг (не очищается prune_report_files) и сколько последних книг каждого отчета хранить
+STANDING_REPORTS_FILE = os.path.join(APP_DIR, 'standing_reports.json')
+STANDING_REPORTS_DIR = os.path.join(JOBS_RESULTS_DIR, 'standing')
+STANDING_REPORTS_KEEP = 7
+
+# Этапы формирования отчета: название и доля общего прогресса в процентах (начало, конец)
+REPORT_PHASES = {
+    'queued': ('В очереди', 0, 0),
+    'fetch': ('Загрузка отчета прибыльности и оборотов', 0, 50),
+    'fetch_report': ('Загрузка отчета прибыльности', 0, 15),
+    'fetch_turnover': ('Загрузка оборотов по складу', 15, 50),
+    'sales_speed': ('Расчет скорости продаж', 50, 70),
+    'build_sheet': ('Формирование Excel', 70, 100)
+}
+
+class Metrics:
+    # Счетчики запросов к МойСклад по endpoint и время этапов формирования отчета.
+    # Общий экземпляр на процесс отдается через /metrics, отдельный на каждый отчет сохраняется в задании
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.http = {}
+        self.phases = {}
+
+    def _endpoint(self, endpoint):
+        stats = self.http.get(endpoint)
+        if stats is None:
+            stats = self.http[endpoint] = {
+                'requests': 0, 'bytes': 0, 'retries': 0, 'status_429': 0, 'errors': 0,
+                'latency_sum': 0.0, 'latency_buckets': [0] * (len(HTTP_LATENCY_BUCKETS) + 1)
+            }
+        return stats
+
+    def record_request(self, endpoint, status, seconds, size=0):
+        # status None - запрос не дошел до сервера (сетевая ошибка)
+        with self.lock:
+            stats = self._endpoint(endpoint)
+            stats['requests'] += 1
+            stats['bytes'] += size
+            stats['latency_sum'] += seconds
+            stats['latency_buckets'][bisect.bisect_left(HTTP_LATENCY_BUCKETS, seconds)] += 1
+            if status == 429:
+                stats['status_429'] += 1
+            if status is None or status >= 400:
+                stats['errors'] += 1
+
+    def record_retry(self, endpoint):
+        with self.lock:
+            self._endpoint(endpoint)['retries'] += 1
+
+    def record_phase(self, phase, seconds):
+        with self.lock:
+            stats = self.phases.setdefault(phase, {'count': 0, 'seconds': 0.0, 'max_seconds': 0.0})
+            stats['count'] += 1
+            stats['seconds'] += seconds
+            stats['max_seconds'] = max(stats['max_seconds'], seconds)
+
+    def snapshot(self):
+        bucket_names = [f"le_{bound}" for bound in HTTP_LATENCY_BUCKETS] + ['le_inf']
+        with self.lock:
+            http = {}
+            for endpoint, stats in self.http.items():
+                http[endpoint] = {key: value for key, value in stats.items() if key != 'latency_buckets'}
+                http[endpoint]['latency_sum'] = round(stats['latency_sum'], 3)
+                # Накопленные значения, как в гистограммах Prometheus
+                http[endpoint]['latency_buckets'] = dict(zip(bucket_names, itertools.accumulate(stats['latency_buckets'])))
+            phases = {phase: {'count': stats['count'], 'seconds': round(stats['seconds'], 3),
+                              'max_seconds': round(stats['max_seconds'], 3)}
+                      for phase, stats in self.phases.items()}
+        return {'http': http, 'phases': phases}
+
+# Метрики всего процесса
+metrics = Metrics()
+
+def token_metrics(token):
+    # Куда записывать метрики: в общие и, если отчет идет с токеном, в метрики этого отчета
+    return (metrics, token.metrics) if token is not None else (metrics,)
+
+def record_phase(phase, seconds, token=None):
+    for target in token_metrics(token):
+        target.record_phase(phase, seconds)
+    logger.debug(f"Этап {phase}: {seconds:.2f} с")
+
+@contextmanager
+def timed_phase(phase, token=None):
+    # Время этапа отчета (fetch_report, fetch_turnover, sales_speed, build_sheet, save)
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_phase(phase, time.perf_counter() - started, token)
+
+def endpoint_name(url):
+    # Путь запроса без адреса API и параметров, UUID заменены на {id}: /entity/store/{id}
+    path = urlsplit(url).path
+    if path.startswith(API_PATH):
+        path = path[len(API_PATH):]
+    return UUID_PATTERN.sub('{id}', path)
+
+class ProcessingCancelled(Exception):
+    def __init__(self):
+        super().__init__("Processing cancelled by user")
+
+class TurnoverSyncConflict(Exception):
+    # Отметка синхронизации склада изменилась, пока загружались операции (сброс истории или синхронизация
+    # в другом процессе): загруженное не записывается, синхронизация начинается заново от новой отметки
+    def __init__(self, store_id):
+        super().__init__(f"Отметка синхронизации склада {store_id} изменилась во время загрузки")
+
+class CancelToken:
+    # Признак отмены одного запроса или задания. Проверяется в циклах загрузки и обработки,
+    # а клиент API прерывает по нему чтение уже начатых ответов
+    def __init__(self):
+        self.event = threading.Event()
+        # Токен сопровождает запрос или задание через все этапы, поэтому с ним передаются и метрики этого отчета
+        self.metrics = Metrics()
+
+    def cancel(self):
+        self.event.set()
+
+    @property
+    def cancelled(self):
+        return self.event.is_set()
+
+    def check(self):
+        if self.event.is_set():
+            raise ProcessingCancelled()
+
+    def sleep(self, seconds):
+        # Пауза, которая прерывается отменой
+        if self.event.wait(seconds):
+            raise ProcessingCancelled()
+
+def check_cancelled(token):
+    if token is not None:
+        token.check()
+
+# Токены отмены активных запросов и заданий: ключ - id задания или request_id формы
+cancel_tokens = {}
+cancel_tokens_lock = threading.Lock()
+
+def register_cancel_token(key):
+    token = CancelToken()
+    with cancel_tokens_lock:
+        cancel_tokens[key] = token
+    return token
+
+def release_cancel_token(key):
+    with cancel_tokens_lock:
+        cancel_tokens.pop(key, None)
+
+def cancel_processing(key):
+    with cancel_tokens_lock:
+        token = cancel_tokens.get(key)
+    if token is None:
+        return False
+    token.cancel()
+    return True
+
+def build_query_url(url, params, filters=None):
+    # Собираем строку запроса вручную: фильтры МойСклад передаются несколькими параметрами filter
+    query_params = [f"{k}={v}" for k, v in params.items()]
+    query_params += [f"filter={f}" for f in (filters or [])]
+    return f"{url}?{'&'.join(query_params)}" if query_params else url
+
+class MoySkladClient:
+    # Общий клиент для всех запросов к API: одна сессия с пулом соединений,
+    # ограниченный пул потоков и учет лимитов API (429 и заголовки X-RateLimit/X-Lognex)
+    def __init__(self, token, max_workers=MOYSKLAD_MAX_WORKERS, max_retries=MOYSKLAD_MAX_RETRIES, timeout=MOYSKLAD_TIMEOUT):
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.timeout = timeout
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers.update({
+            'Authorization': f'Bearer {token}',
+            'Accept': 'application/json;charset=utf-8',
+            'Accept-Encoding': 'gzip'
+        })
+
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='moysklad')
+        # Семафор ограничивает число запросов "в полете" с учетом вызовов из основного потока
+        self.slots = threading.BoundedSemaphore(max_workers)
+        self.worker_state = threading.local()
+        self.rate_lock = threading.Lock()
+        self.pause_until = 0.0
+
+    def _pause(self, seconds):
+        with self.rate_lock:
+            self.pause_until = max(self.pause_until, time.monotonic() + seconds)
+
+    def _sleep(self, seconds, token=None):
+        if token is not None:
+            token.sleep(seconds)
+        else:
+            time.sleep(seconds)
+
+    def _wait_for_rate_limit(self, token=None):
+        while True:
+            with self.rate_lock:
+                delay = self.pause_until - time.monotonic()
+            if delay <= 0:
+                return
+            self._sleep(delay, token)
+
+    def _read_body(self, response, token):
+        # Тело ответа читаем частями, чтобы отмена прерывала и уже начатую загрузку страницы
+        chunks = []
+        try:
+            for chunk in response.iter_content(chunk_size=64 * 1024):
+                check_cancelled(token)
+                chunks.append(chunk)
+        except ProcessingCancelled:
+            response.close()
+            raise
+        response._content = b''.join(chunks)
+
+    def _read_rate_limit_headers(self, response):
+        # X-RateLimit-Remaining - сколько запросов осталось в текущем окне,
+        # X-Lognex-Retry-TimeInterval - длина окна в миллисекундах
+        headers = response.headers
+        try:
+            remaining = int(headers.get('X-RateLimit-Remaining', ''))
+            limit = int(headers.get('X-RateLimit-Limit', ''))
+            interval_ms = int(headers.get('X-Lognex-Retry-TimeInterval', ''))
+        except ValueError:
+            return
+        if remaining < self.max_workers and limit > 0:
+            # Лимит почти исчерпан - притормаживаем, пока окно не освободит запрос
+            self._pause(interval_ms / 1000 / limit)
+
+    def _retry_delay(self, response, attempt):
+        if response is not None:
+            # X-Lognex-Retry-After - через сколько миллисекунд можно повторить запрос
+            retry_after = response.headers.get('X-Lognex-Retry-After')
+            if retry_after and retry_after.isdigit():
+                return int(retry_after) / 1000
+            retry_after = response.headers.get('Retry-After')
+            if retry_after and retry_after.isdigit():
+                return int(retry_after)
+        return min(0.5 * 2 ** attempt, 30)
+
+    def get(self, url, params=None, token=None):
+        endpoint = endpoint_name(url)
+        targets = token_metrics(token)
+        for attempt in range(self.max_retries + 1):
+            check_cancelled(token)
+            self._wait_for_rate_limit(token)
+            if attempt:
+                for target in targets:
+                    target.record_retry(endpoint)
+
+            try:
+                with self.slots:
+                    started = time.perf_counter()
+                    response = self.session.get(url, params=params, timeout=self.timeout, stream=True)
+                    self._read_body(response, token)
+                    seconds = time.perf_counter() - started
+            except requests.ConnectionError as e:
+                for target in targets:
+                    target.record_request(endpoint, None, time.perf_counter() - started)
+                if attempt == self.max_retries:
+                    raise
+                delay = self._retry_delay(None, attempt)
+                logger.warning(f"Сетевая ошибка при запросе к МойСклад: {str(e)}, повтор через {delay:.1f} с")
+                self._sleep(delay, token)
+                continue
+
+            for target in targets:
+                target.record_request(endpoint, response.status_code, seconds, len(response.content))
+            self._read_rate_limit_headers(response)
+
+            if response.status_code not in (429, 503) or attempt == self.max_retries:
+                return response
+
+            delay = self._retry_delay(response, attempt)
+            logger.warning(f"МойСклад ответил {response.status_code}, повтор через {delay:.1f} с")
+            # Пауза общая для всех потоков: лимит считается на весь аккаунт
+            self._pause(delay)
+
+    def _run_in_worker(self, fn, item):
+        self.worker_state.active = True
+        try:
+            return fn(item)
+        finally:
+            self.worker_state.active = False
+
+    def map(self, fn, items):
+        # Выполняет fn для каждого элемента параллельно, сохраняя порядок результатов.
+        # Из потока пула выполняем последовательно, чтобы не заблокировать пул вложенными задачами
+        if getattr(self.worker_state, 'active', False):
+            return [fn(item) for item in items]
+        return list(self.executor.map(lambda item: self._run_in_worker(fn, item), items))
+
+    def iter_pages(self, url, params=None, filters=None, limit=1000, token=None, on_page=None, project=None):
+        # Страницы по порядку по мере загрузки. Первая дает meta.size, следующие загружаются параллельно
+        # не дальше чем на max_workers страниц вперед, поэтому в памяти несколько страниц, а не весь результат.
+        # project - преобразование строки сразу после разбора страницы (None - строка пропускается),
+        # чтобы не держать полные JSON-строки
+        params = dict(params or {})
+
+        def fetch_page(offset):
+            page_url = build_query_url(url, {**params, 'limit': limit, 'offset': offset}, filters)
+            logger.debug("Отправляем запрос: URL=%s", page_url)
+            response = self.get(page_url, token=token)
+            if response.status_code != 200:
+                error_message = f"Ошибка при запросе {url}: {response.status_code}. Ответ сервера: {response.text}"
+                logger.error(error_message)
+                raise Exception(error_message)
+            page = response.json()
+            if project:
+                page['rows'] = [row for row in map(project, page.get('rows', [])) if row is not None]
+            return page
+
+        first_page = fetch_page(0)
+        total_count = first_page.get('meta', {}).get('size', len(first_page.get('rows', [])))
+        logger.debug(f"Всего записей: {total_count}")
+        # Прогресс - по числу загруженных строк API, а не оставшихся после project
+        if on_page:
+            on_page(min(limit, total_count), total_count)
+        yield first_page
+
+        offsets = iter(range(limit, total_count, limit))
+        if getattr(self.worker_state, 'active', False):
+            # Из потока пула - последовательно, как в map
+            for offset in offsets:
+                page = fetch_page(offset)
+                if on_page:
+                    on_page(min(offset + limit, total_count), total_count)
+                yield page
+            return
+
+        pending = deque(
+            (offset, self.executor.submit(self._run_in_worker, fetch_page, offset))
+            for offset in itertools.islice(offsets, self.max_workers)
+        )
+        try:
+            while pending:
+                offset, future = pending.popleft()
+                page = future.result()
+                next_offset = next(offsets, None)
+                if next_offset is not None:
+                    pending.append((next_offset, self.executor.submit(self._run_in_worker, fetch_page, next_offset)))
+                if on_page:
+                    on_page(min(offset + limit, total_count), total_count)
+                yield page
+        finally:
+            # Потребитель остановился (ошибка, отмена) - незапущенные страницы не загружаем
+            for _, future in pending:
+                future.cancel()
+
+    def get_all_rows(self, url, params=None, filters=None, limit=1000, token=None, on_page=None, project=None):
+        # Все строки сразу: meta первой страницы и строки всех страниц (см. iter_pages)
+        pages = self.iter_pages(url, params, filters, limit, token, on_page, project)
+        first_page = next(pages)
+        rows = list(first_page.get('rows', []))
+        for page in pages:
+            rows.extend(page.get('rows', []))
+        return first_page.get('meta', {}), rows
+
+moysklad = MoySkladClient(MOYSKLAD_TOKEN)
+
+class ReferenceCache:
+    # Кэш справочных данных. Ключ - аккаунт (хэш токена) и имя справочника.
+    # В памяти процесса - "сырые" данные из API и построенное из них значение; "сырые" данные также
+    # пишутся в общую базу SQLite, из которой их берут другие процессы (воркеры) и перезапущенный процесс
+    def __init__(self, ttl, db_file=None):
+        self.ttl = ttl
+        self.db_file = db_file
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.load_locks = {}
+        if self.db_file:
+            conn = self._connect()
+            try:
+                conn.execute('''
+                    CREATE TABLE IF NOT EXISTS reference_data (
+                        key TEXT PRIMARY KEY,
+                        loaded_at REAL NOT NULL,
+                        raw TEXT NOT NULL
+                    )
+                ''')
+            finally:
+                conn.close()
+
+    @staticmethod
+    def account_key(token):
+        return hashlib.sha256(token.encode('utf-8')).hexdigest()[:16]
+
+    def _connect(self):
+        # Автофиксация; ожидание блокировки - на время загрузки справочника другим процессом
+        conn = sqlite3.connect(self.db_file, timeout=REFERENCE_CACHE_LOCK_TIMEOUT, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def _load_lock(self, key):
+        with self.lock:
+            return self.load_locks.setdefault(key, threading.Lock())
+
+    def _fresh(self, loaded_at):
+        return time.time() - loaded_at < self.ttl
+
+    def _shared_loaded_at(self, key):
+        conn = self._connect()
+        try:
+            row = conn.execute('SELECT loaded_at FROM reference_data WHERE key = ?', (key,)).fetchone()
+        finally:
+            conn.close()
+        return row['loaded_at'] if row else None
+
+    def _fresh_entry(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+        if not entry or not self._fresh(entry['loaded_at']):
+            return None
+        # Копия в памяти периодически сверяется с базой: другой процесс мог сбросить или обновить справочник
+        if self.db_file and time.time() - entry['checked_at'] >= REFERENCE_CACHE_SYNC_INTERVAL:
+            if self._shared_loaded_at(key) != entry['loaded_at']:
+                return None
+            entry['checked_at'] = time.time()
+        return entry
+
+    def _remember(self, key, loaded_at, raw):
+        entry = {'loaded_at': loaded_at, 'checked_at': time.time(), 'raw': raw, 'value': None}
+        with self.lock:
+            self.entries[key] = entry
+        return entry
+
+    def _load(self, key, name, loader):
+        if not self.db_file:
+            logger.info(f"Загрузка справочника {name} из API")
+            return self._remember(key, time.time(), loader())
+
+        conn = self._connect()
+        try:
+            # Блокировка записи в базе общая для процессов: пока один загружает справочник из API,
+            # остальные ждут здесь и затем берут загруженное им
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = conn.execute('SELECT loaded_at, raw FROM reference_data WHERE key = ?', (key,)).fetchone()
+                if row and self._fresh(row['loaded_at']):
+                    conn.execute('COMMIT')
+                    return self._remember(key, row['loaded_at'], json.loads(row['raw']))
+
+                logger.info(f"Загрузка справочника {name} из API")
+                loaded_at = time.time()
+                raw = loader()
+                conn.execute('INSERT OR REPLACE INTO reference_data (key, loaded_at, raw) VALUES (?, ?, ?)',
+                             (key, loaded_at, json.dumps(raw, ensure_ascii=False)))
+                conn.execute('COMMIT')
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+        finally:
+            conn.close()
+        return self._remember(key, loaded_at, raw)
+
+    def get(self, token, name, loader, build=None):
+        key = f"{self.account_key(token)}|{name}"
+        entry = self._fresh_entry(key)
+        if entry is None:
+            # Один загрузчик на ключ: параллельные запросы ждут его, а не идут в API сами
+            with self._load_lock(key):
+                entry = self._fresh_entry(key)
+                if entry is None:
+                    entry = self._load(key, name, loader)
+
+        if entry['value'] is None:
+            value = build(entry['raw']) if build else entry['raw']
+            entry['value'] = value
+        return entry['value']
+
+    def invalidate(self, token=None, name=None):
+        prefix = f"{self.account_key(token)}|" if token else ''
+        with self.lock:
+            for key in list(self.entries):
+                if key.startswith(prefix) and (name is None or key.endswith(f"|{name}")):
+                    del self.entries[key]
+        if not self.db_file:
+            return
+        # Остальные процессы увидят сброс при следующей сверке с базой
+        conn = self._connect()
+        try:
+            for row in conn.execute('SELECT key FROM reference_data').fetchall():
+                if row['key'].startswith(prefix) and (name is None or row['key'].endswith(f"|{name}")):
+                    conn.execute('DELETE FROM reference_data WHERE key = ?', (row['key'],))
+        finally:
+            conn.close()
+
+reference_cache = ReferenceCache(REFERENCE_CACHE_TTL, REFERENCE_CACHE_FILE)
+
+class ReportCache:
+    # LRU-кэш результатов отчета в памяти процесса. Ключ - нормализованные параметры, влияющие на данные
+    # (аккаунт, склад, период, группы); срок планирования и ручные остатки применяются при выводе в Excel
+    def __init__(self, ttl, max_entries, max_rows):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_rows = max_rows
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(token, params):
+        groups = ','.join(sorted(set(group for group in params['product_groups'] if group)))
+        stores = ','.join(report_store_ids(params))
+        return (ReferenceCache.account_key(token), stores, params['start_date'], params['end_date'], groups)
+
+    @staticmethod
+    def entry_rows(entry):
+        return len(entry['products_data'])
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if time.time() - entry['created_at'] >= self.ttl:
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return entry
+
+    def put(self, key, products_data):
+        entry = {'created_at': time.time(), 'products_data': products_data}
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            total_rows = sum(self.entry_rows(cached) for cached in self.entries.values())
+            # Вытесняем давно не использованные отчеты, но последний оставляем, даже если он один больше лимита
+            while len(self.entries) > 1 and (len(self.entries) > self.max_entries or total_rows > self.max_rows):
+                _, evicted = self.entries.popitem(last=False)
+                total_rows -= self.entry_rows(evicted)
+        return entry
+
+    def invalidate(self):
+        with self.lock:
+            self.entries.clear()
+
+report_cache = ReportCache(REPORT_CACHE_TTL, REPORT_CACHE_MAX_ENTRIES, REPORT_CACHE_MAX_ROWS)
+
+class JobStore:
+    # Состояние фоновых заданий хранится в SQLite, чтобы переживать перезапуск процесса
+    COLUMNS = ('status', 'phase', 'done', 'total', 'params', 'file_path', 'error', 'metrics',
+               'created_at', 'started_at', 'phase_started_at', 'finished_at', 'updated_at')
+
+    def __init__(self, db_file):
+        self.db_file = db_file
+        self._execute('''
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                phase TEXT,
+                done INTEGER DEFAULT 0,
+                total INTEGER DEFAULT 0,
+                params TEXT,
+                file_path TEXT,
+                error TEXT,
+                metrics TEXT,
+                created_at REAL,
+                started_at REAL,
+                phase_started_at REAL,
+                finished_at REAL,
+                updated_at REAL
+            )
+        ''')
+        # База, созданная до появления метрик заданий
+        columns = {row['name'] for row in self._execute('PRAGMA table_info(jobs)')}
+        if 'metrics' not in columns:
+            self._execute('ALTER TABLE jobs ADD COLUMN metrics TEXT')
+
+    def _execute(self, sql, args=()):
+        conn = sqlite3.connect(self.db_file, timeout=30)
+        conn.row_factory = sqlite3.Row
+        try:
+            with conn:
+                return conn.execute(sql, args).fetchall()
+        finally:
+            conn.close()
+
+    def create(self, params):
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        self._execute(
+            'INSERT INTO jobs (id, status, phase, params, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?)',
+            (job_id, 'queued', 'queued', json.dumps(params, ensure_ascii=False), now, now)
+        )
+        return job_id
+
+    @staticmethod
+    def _decode(row):
+        job = dict(row)
+        job['params'] = json.loads(job['params']) if job['params'] else {}
+        job['metrics'] = json.loads(job['metrics']) if job['metrics'] else None
+        return job
+
+    def get(self, job_id):
+        rows = self._execute('SELECT * FROM jobs WHERE id = ?', (job_id,))
+        return self._decode(rows[0]) if rows else None
+
+    def standing_jobs(self, name):
+        # Задания постоянного отчета name (params.standing_report), новые первыми
+        rows = self._execute(
+            "SELECT * FROM jobs WHERE json_extract(params, '$.standing_report') = ? ORDER BY created_at DESC", (name,)
+        )
+        return [self._decode(row) for row in rows]
+
+    def update(self, job_id, **fields):
+        fields['updated_at'] = time.time()
+        for name in fields:
+            if name not in self.COLUMNS:
+                raise ValueError(f"Неизвестное поле задания: {name}")
+        assignments = ', '.join(f"{name} = ?" for name in fields)
+        self._execute(f'UPDATE jobs SET {assignments} WHERE id = ?', (*fields.values(), job_id))
+
+    def start(self, job_id):
+        # Перевод в running только из queued/running одним условным UPDATE: остановка, записанная
+        # после чтения задания, не перезаписывается. False - задание уже остановлено или удалено
+        now = time.time()
+        rows = self._execute(
+            "UPDATE jobs SET status = 'running', started_at = ?, updated_at = ? "
+            "WHERE id = ? AND status IN ('queued', 'running') RETURNING id",
+            (now, now, job_id)
+        )
+        return bool(rows)
 
-# Добавим глобальную переменную для отслеживания состояния
-processing_cancelled = False
-processing_lock = threading.Lock()
+    def unfinished(self):
+        rows = self._execute("SELECT id FROM jobs WHERE status IN ('queued', 'running') ORDER BY created_at")
+        return [row['id'] for row in rows]
+
+job_store = JobStore(JOBS_DB_FILE)
+
+class JobLocks:
+    # Блокировки заданий между процессами: flock на файле задания держится, пока задание в очереди
+    # или выполняется, и снимается системой при завершении процесса. Без fcntl (Windows) - в пределах процесса
+    def __init__(self, lock_dir):
+        self.lock_dir = lock_dir
+        self.files = {}
+        self.lock = threading.Lock()
+
+    def acquire(self, job_id):
+        # False - задание уже выполняется этим или другим процессом
+        with self.lock:
+            if job_id in self.files:
+                return False
+            if fcntl is None:
+                self.files[job_id] = None
+                return True
+            os.makedirs(self.lock_dir, exist_ok=True)
+            lock_file = open(os.path.join(self.lock_dir, f"job_{job_id}.lock"), 'a')
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                lock_file.close()
+                return False
+            self.files[job_id] = lock_file
+            return True
+
+    def release(self, job_id):
+        with self.lock:
+            lock_file = self.files.pop(job_id, None)
+        if lock_file:
+            try:
+                os.remove(lock_file.name)
+            except OSError:
+                pass
+            lock_file.close()
+
+job_locks = JobLocks(JOBS_LOCK_DIR)
+
+@dataclass(slots=True)
+class TurnoverOperation:
+    # Строка отчета turnover/byoperations: только поля, нужные для расчета скорости продаж и пути группы
+    assortment_id: str
+    moment: str
+    quantity: float
+    operation_type: str
+    assortment_href: str
+    uuid_href: str
+    folder_href: str
+    folder_name: str
+
+def project_turnover_row(row):
+    # Сокращает строку оборотов до TurnoverOperation сразу после разбора страницы (см. get_all_rows)
+    assortment = row.get('assortment', {})
+    assortment_meta = assortment.get('meta', {})
+    product_folder = assortment.get('productFolder', {})
+    operation = row.get('operation', {})
+    return TurnoverOperation(
+        get_assortment_id(row),
+        operation.get('moment', ''),
+        row.get('quantity', 0),
+        operation.get('meta', {}).get('type', ''),
+        assortment_meta.get('href', ''),
+        assortment_meta.get('uuidHref', ''),
+        product_folder.get('meta', {}).get('href', ''),
+        product_folder.get('name', '')
+    )
+
+class TurnoverStore:
+    # Операции по складам из отчета turnover/byoperations в SQLite. Для каждого склада хранится отметка
+    # synced_to - до какого момента операции загружены, следующая синхронизация начинается с нее.
+    # Из операций поддерживаются дневные итоги по товарам (turnover_daily): продано по розничным продажам,
+    # время в наличии и остаток на конец дня - скорость продаж за любой период считается суммой по ним
+    MOMENT_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+    def __init__(self, db_file):
+        self.db_file = db_file
+        self.lock = threading.Lock()
+        self.sync_locks = {}
+        conn = self._connect()
+        try:
+            with conn:
+                conn.executescript('''
+                    CREATE TABLE IF NOT EXISTS turnover_operations (
+                        store_id TEXT NOT NULL,
+                        assortment_id TEXT NOT NULL,
+                        moment TEXT NOT NULL,
+                        quantity REAL NOT NULL,
+                        operation_type TEXT,
+                        assortment_href TEXT,
+                        uuid_href TEXT,
+                        folder_href TEXT,
+                        folder_name TEXT
+                    );
+                    CREATE INDEX IF NOT EXISTS turnover_operations_store_moment
+                        ON turnover_operations (store_id, moment);
+                    CREATE TABLE IF NOT EXISTS turnover_sync (
+                        store_id TEXT PRIMARY KEY,
+                        synced_to TEXT NOT NULL,
+                        synced_at REAL
+                    );
+                    CREATE TABLE IF NOT EXISTS turnover_daily (
+                        store_id TEXT NOT NULL,
+                        assortment_id TEXT NOT NULL,
+                        day TEXT NOT NULL,
+                        sold INTEGER NOT NULL,
+                        on_stock_us INTEGER NOT NULL,
+                        closing_stock INTEGER NOT NULL,
+                        PRIMARY KEY (store_id, assortment_id, day)
+                    );
+                    CREATE TABLE IF NOT EXISTS turnover_assortments (
+                        store_id TEXT NOT NULL,
+                        assortment_id TEXT NOT NULL,
+                        assortment_href TEXT,
+                        uuid_href TEXT,
+                        folder_href TEXT,
+                        folder_name TEXT,
+                        PRIMARY KEY (store_id, assortment_id)
+                    );
+                ''')
+        finally:
+            conn.close()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_file, timeout=30)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def sync_lock(self, store_id):
+        # Один синхронизирующий поток на склад: параллельные отчеты по складу ждут его
+        with self.lock:
+            return self.sync_locks.setdefault(store_id, threading.Lock())
+
+    def synced_to(self, store_id):
+        conn = self._connect()
+        try:
+            row = conn.execute('SELECT synced_to FROM turnover_sync WHERE store_id = ?', (store_id,)).fetchone()
+        finally:
+            conn.close()
+        return row['synced_to'] if row else None
+
+    def store_ids(self):
+        # Склады, по которым уже загружалась история операций
+        conn = self._connect()
+        try:
+            return [row['store_id'] for row in conn.execute('SELECT store_id FROM turnover_sync ORDER BY synced_at')]
+        finally:
+            conn.close()
+
+    def has_daily(self, store_id):
+        conn = self._connect()
+        try:
+            return conn.execute('SELECT 1 FROM turnover_daily WHERE store_id = ? LIMIT 1', (store_id,)).fetchone() is not None
+        finally:
+            conn.close()
+
+    @staticmethod
+    def record_from_operation(store_id, operation):
+        return (
+            store_id,
+            operation.assortment_id,
+            operation.moment,
+            operation.quantity,
+            operation.operation_type,
+            operation.assortment_href,
+            operation.uuid_href,
+            operation.folder_href,
+            operation.folder_name
+        )
+
+    def replace_since(self, store_id, moment_from, operations, synced_to, day_from=None, expected_synced_to=None):
+        # Операции с moment_from заменяются загруженными, дневные итоги с day_from (по умолчанию - день
+        # moment_from) пересчитываются, отметка переносится - все в одной транзакции,
+        # чтобы прерванная синхронизация не оставила дубликатов, дыр или итогов, не совпадающих с операциями.
+        # expected_synced_to - отметка, от которой начиналась загрузка: если она уже другая (история сброшена
+        # или ее обновил другой процесс), ничего не записывается и выбрасывается TurnoverSyncConflict
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute('BEGIN IMMEDIATE')
+                row = conn.execute('SELECT synced_to FROM turnover_sync WHERE store_id = ?', (store_id,)).fetchone()
+                if (row['synced_to'] if row else None) != expected_synced_to:
+                    raise TurnoverSyncConflict(store_id)
+                conn.execute('DELETE FROM turnover_operations WHERE store_id = ? AND moment >= ?', (store_id, moment_from))
+                conn.executemany('INSERT INTO turnover_operations VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                 (self.record_from_operation(store_id, operation) for operation in operations))
+                self._refresh_daily(conn, store_id, day_from or moment_from[:10])
+                conn.execute('INSERT OR REPLACE INTO turnover_sync (store_id, synced_to, synced_at) VALUES (?, ?, ?)',
+                             (store_id, synced_to, time.time()))
+        finally:
+            conn.close()
+
+    def _refresh_daily(self, conn, store_id, day_from):
+        # Остаток на начало day_from - остаток на конец последнего дня с операциями до него
+        # (SQLite берет остальные столбцы из строки с MAX(day))
+        opening_stock = {
+            assortment_id: closing_stock
+            for assortment_id, closing_stock, _ in conn.execute(
+                '''SELECT assortment_id, closing_stock, MAX(day) FROM turnover_daily
+                   WHERE store_id = ? AND day < ? GROUP BY assortment_id''',
+                (store_id, day_from)
+            )
+        }
+        assortment_ids, moments, quantities, is_retail = [], [], [], []
+        assortment_info = {}
+        records = conn.execute(
+            '''SELECT assortment_id, moment, quantity, operation_type, assortment_href, uuid_href, folder_href, folder_name
+               FROM turnover_operations WHERE store_id = ? AND moment >= ? ORDER BY rowid''',
+            (store_id, f"{day_from} 00:00:00")
+        )
+        for assortment_id, moment, quantity, operation_type, assortment_href, uuid_href, folder_href, folder_name in records:
+            assortment_ids.append(assortment_id)
+            moments.append(moment)
+            quantities.append(quantity)
+            is_retail.append(operation_type == 'retaildemand')
+            if assortment_id not in assortment_info:
+                assortment_info[assortment_id] = (store_id, assortment_id, assortment_href, uuid_href, folder_href, folder_name)
+
+        daily = calculate_daily_turnover(
+            np.array(assortment_ids, dtype=object), np.array(moments, dtype='datetime64[us]'),
+            np.array(quantities, dtype=np.float64), np.array(is_retail, dtype=bool), opening_stock
+        )
+        conn.execute('DELETE FROM turnover_daily WHERE store_id = ? AND day >= ?', (store_id, day_from))
+        conn.executemany('INSERT INTO turnover_daily VALUES (?, ?, ?, ?, ?, ?)',
+                         ((store_id, *row) for row in daily))
+        # Сведения о товаре - из его первой операции, как у calculate_sales_speed
+        conn.executemany('INSERT OR IGNORE INTO turnover_assortments VALUES (?, ?, ?, ?, ?, ?)',
+                         assortment_info.values())
+
+    def daily_columns(self, store_id, day_to):
+        # Дневные итоги склада до day_to включительно, по товарам и дням - столбцы для calculate_period_sales_speeds,
+        # и сведения о товарах: ссылка на группу, ее название, href и uuidHref
+        assortment_ids, days, sold, on_stock_us, closing_stock = [], [], [], [], []
+        conn = self._connect()
+        try:
+            records = conn.execute(
+                '''SELECT assortment_id, day, sold, on_stock_us, closing_stock FROM turnover_daily
+                   WHERE store_id = ? AND day <= ? ORDER BY assortment_id, day''',
+                (store_id, day_to)
+            )
+            for row in records:
+                assortment_ids.append(row[0])
+                days.append(row[1])
+                sold.append(row[2])
+                on_stock_us.append(row[3])
+                closing_stock.append(row[4])
+            assortment_info = {
+                row[0]: tuple(row[1:])
+                for row in conn.execute(
+                    '''SELECT assortment_id, assortment_href, uuid_href, folder_href, folder_name
+                       FROM turnover_assortments WHERE store_id = ?''',
+                    (store_id,)
+                )
+            }
+        finally:
+            conn.close()
+        return {
+            'assortment_id': np.array(assortment_ids, dtype=object),
+            'day': np.array(days, dtype='datetime64[D]'),
+            'sold': np.array(sold, dtype=np.int64),
+            'on_stock_us': np.array(on_stock_us, dtype=np.int64),
+            'closing_stock': np.array(closing_stock, dtype=np.int64)
+        }, assortment_info
+
+    def reset(self, store_id=None):
+        # Полная перезагрузка истории при следующем отчете. Идущая в этом процессе синхронизация склада
+        # (всех складов при полном сбросе) дожидается; синхронизацию в другом процессе отменит проверка
+        # отметки в replace_since
+        store_ids = [store_id] if store_id else sorted(set(self.store_ids()) | set(self.sync_locks))
+        with ExitStack() as locks:
+            for locked_store_id in store_ids:
+                locks.enter_context(self.sync_lock(locked_store_id))
+            conn = self._connect()
+            try:
+                with conn:
+                    for table in ('turnover_operations', 'turnover_daily', 'turnover_assortments', 'turnover_sync'):
+                        if store_id:
+                            conn.execute(f'DELETE FROM {table} WHERE store_id = ?', (store_id,))
+                        else:
+                            conn.execute(f'DELETE FROM {table}')
+            finally:
+                conn.close()
+
+turnover_store = TurnoverStore(TURNOVER_DB_FILE)
+report_executor = ThreadPoolExecutor(max_workers=REPORT_WORKERS, thread_name_prefix='report')
+
+class JobProgress:
+    # Передается в этапы отчета как progress(phase, done, total) и пишет прогресс задания в базу,
+    # но не чаще JOB_PROGRESS_INTERVAL, чтобы не нагружать SQLite на каждой строке.
+    # Заодно замечает остановку задания из другого процесса (статус cancelled в базе) и отменяет token
+    def __init__(self, job_id, token=None):
+        self.job_id = job_id
+        self.token = token
+        self.phase = None
+        self.last_write = 0.0
+        self.lock = threading.Lock()
+
+    def __call__(self, phase, done, total):
+        now = time.time()
+        with self.lock:
+            phase_changed = phase != self.phase
+            if not phase_changed and done < total and now - self.last_write < JOB_PROGRESS_INTERVAL:
+                return
+            fields = {'phase': phase, 'done': done, 'total': total}
+            if phase_changed:
+                fields['phase_started_at'] = now
+                self.phase = phase
+            self.last_write = now
+        job_store.update(self.job_id, **fields)
+        if self.token is not None:
+            job = job_store.get(self.job_id)
+            if job and job['status'] == 'cancelled':
+                self.token.cancel()
+
+class FetchProgress:
+    # Страницы отчета прибыльности и обороты складов загружаются одновременно, поэтому показываются одной фазой
+    # fetch: выполнено - сумма долей обоих этапов с весами по их долям в REPORT_PHASES, без скачков между
+    # этапами и назад. Прогресс остальных этапов передается как есть
+    PHASES = ('fetch_report', 'fetch_turnover')
+    STEPS = 1000
+
+    def __init__(self, progress):
+        self.progress = progress
+        self.fractions = dict.fromkeys(self.PHASES, 0.0)
+        self.weights = {phase: REPORT_PHASES[phase][2] - REPORT_PHASES[phase][1] for phase in self.PHASES}
+        self.lock = threading.Lock()
+
+    def __call__(self, phase, done, total):
+        if phase not in self.fractions:
+            self.progress(phase, done, total)
+            return
+        with self.lock:
+            self.fractions[phase] = max(self.fractions[phase], min(done / total, 1.0) if total else 1.0)
+            fraction = sum(self.fractions[name] * self.weights[name] for name in self.PHASES) / sum(self.weights.values())
+        self.progress('fetch', round(fraction * self.STEPS), self.STEPS)
 
 def render_group_options(groups, level=0):
     result = []
@@ -34,230 +1123,796 @@ def render_group_options(groups, level=0):
             result.extend(render_group_options(group['children'], level + 1))
     return '\n'.join(result)
 
+def split_ids(values):
+    # Идентификаторы складов или групп: строка или список строк, в каждой - один или несколько через запятую.
+    # Порядок сохраняется, пустые значения и повторы отбрасываются
+    if isinstance(values, str):
+        values = [values]
+    if not isinstance(values, (list, tuple)) or not all(isinstance(value, str) for value in values):
+        raise ValueError(f"Ожидается строка или список строк: {values!r}")
+    return list(dict.fromkeys(item.strip() for value in values for item in value.split(',') if item.strip()))
+
+def report_options(store_ids, store_layout, group_split, product_groups, manual_stock_settings):
+    # Склады, раскладка, разбиение по группам, группы товаров и минимальные остатки отчета с проверкой -
+    # общие для формы (parse_report_form) и постоянных отчетов (load_standing_reports)
+    options = {'store_ids': split_ids(store_ids)}
+    if not options['store_ids']:
+        raise ValueError("Не выбран склад")
+    options['store_layout'] = store_layout or STORE_LAYOUTS[0]
+    if options['store_layout'] not in STORE_LAYOUTS:
+        raise ValueError(f"Неизвестная раскладка складов: {options['store_layout']}")
+    options['group_split'] = group_split or GROUP_SPLITS[0]
+    if options['group_split'] not in GROUP_SPLITS:
+        raise ValueError(f"Неизвестное разбиение по группам: {options['group_split']}")
+    options['product_groups'] = split_ids(product_groups or [])
+    # Настройки минимальных остатков хранятся строкой JSON, как приходят из формы, и сразу проверяются
+    if not isinstance(manual_stock_settings, str):
+        manual_stock_settings = json.dumps(manual_stock_settings or [], ensure_ascii=False)
+    parse_manual_stock_settings(manual_stock_settings)
+    options['manual_stock_settings'] = manual_stock_settings
+    return options
+
+def parse_report_form(form):
+    # Параметры отчета из формы - общие для синхронного формирования и фоновых заданий
+    params = {
+        'start_date': form['start_date'],
+        'end_date': form['end_date'],
+        'planning_days': int(form['planning_days'])
+    }
+    
+    # Один или несколько складов: повторяющееся поле store_id или список через запятую, порядок выбора сохраняется.
+    # Группы - ТОЛЬКО из блока "Группа товаров:"
+    params.update(report_options(form.getlist('store_id'), form.get('store_layout'), form.get('group_split'),
+                                 form.get('final_product_groups', ''), form.get('final_manual_stock_groups', '[]')))
+    
+    # Принудительное обновление: не брать результат из кэша отчетов
+    params['force_refresh'] = form.get('force_refresh') in ('1', 'true', 'on')
+    
+    logger.debug(f"Final product groups being sent to get_report_data: {params['product_groups']}")  # Отладка
+    logger.debug(f"Manual stock settings being sent: {params['manual_stock_settings']}")  # Отладка
+    return params
+
+def report_store_ids(params):
+    # Склады отчета; задания, сохраненные до выбора нескольких складов, содержат только store_id
+    return params.get('store_ids') or [params['store_id']]
+
 @app.route('/', methods=['GET', 'POST'])
 def index():
     if request.method == 'POST':
-        start_date = request.form['start_date']
-        end_date = request.form['end_date']
-        store_id = request.form['store_id']
-        planning_days = int(request.form['planning_days'])
-        
-        # Получаем значения ТОЛЬКО из блока "Группа товаров:"
-        product_groups = []
-        if 'final_product_groups' in request.form and request.form['final_product_groups']:
-            raw_groups = request.form['final_product_groups']
-            print(f"Raw product groups from form (final_product_groups): {raw_groups}")  # Отладка
-            product_groups = [group for group in raw_groups.split(',') if group]
-            print(f"Processed product groups: {product_groups}")  # Отладка
-        
-        # Получаем настройки минимальных остатков отдельно
-        manual_stock_settings = request.form.get('final_manual_stock_groups', '[]')
-        
-        print(f"Final product groups being sent to get_report_data: {product_groups}")  # Отладка
-        print(f"Manual stock settings being sent: {manual_stock_settings}")  # Отладка
+        # Синхронное формирование (для скриптов); интерфейс использует фоновые задания /jobs
+        try:
+            params = parse_report_form(request.form)
+        except ValueError as e:
+            return str(e), 400
+        # request_id передается клиентом, чтобы остановить именно этот запрос через /stop_processing
+        request_id = request.form.get('request_id') or uuid.uuid4().hex
+        token = register_cancel_token(request_id)
         
         try:
-            report_data = get_report_data(start_date, end_date, store_id, product_groups)
+            report = load_report(params, token=token)
             
-            if not report_data or 'rows' not in report_data or not report_data['rows']:
+            if report is None:
                 return "Нет данных для формирования отчета для выбранных параметров", 404
             
-            excel_file = create_excel_report(report_data, store_id, end_date, planning_days, manual_stock_settings)
+            excel_file = create_excel_report(None, report_store_ids(params), params['end_date'],
+                                             params['planning_days'], params['manual_stock_settings'], token=token,
+                                             products_data=report['products_data'],
+                                             store_layout=params.get('store_layout', 'columns'),
+                                             group_split=params.get('group_split', 'none'))
             
-            return send_file(excel_file, as_attachment=True, download_name='profitability_report.xlsx')
+            return send_file(excel_file, as_attachment=True, download_name='profitability_report.xlsx',
+                             mimetype=XLSX_MIMETYPE)
+        except ProcessingCancelled as e:
+            return str(e), 499
         except Exception as e:
-            print(f"Error in index(): {str(e)}")
+            logger.error(f"Error in index(): {str(e)}")
             return f"Произошла ошибка при формировании отчета: {str(e)}", 500
+        finally:
+            logger.info(f"Метрики отчета {request_id}: {json.dumps(token.metrics.snapshot(), ensure_ascii=False)}")
+            release_cancel_token(request_id)
     
     stores = get_stores()
     product_groups = get_product_groups()
-    return render_template('index.html', stores=stores, product_groups=product_groups, render_group_options=render_group_options)
+    # Ошибка в постоянных отчетах не должна мешать открыть форму
+    try:
+        standing_reports = describe_standing_reports()
+    except Exception as e:
+        logger.warning(f"Не удалось получить постоянные отчеты: {str(e)}")
+        standing_reports = []
+    return render_template('index.html', stores=stores, product_groups=product_groups, render_group_options=render_group_options,
+                           standing_reports=standing_reports, format_age=format_age)
+
+@app.route('/jobs', methods=['POST'])
+def create_job():
+    try:
+        params = parse_report_form(request.form)
+    except ValueError as e:
+        return str(e), 400
+    job_id = job_store.create(params)
+    job_locks.acquire(job_id)
+    report_executor.submit(run_report_job, job_id)
+    logger.info(f"Создано задание {job_id}")
+    return jsonify({'job_id': job_id, 'status_url': url_for('job_status', job_id=job_id)}), 202
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    job = job_store.get(job_id)
+    if not job:
+        abort(404)
+    return jsonify(describe_job(job))
+
+@app.route('/jobs/<job_id>/file')
+def job_file(job_id):
+    job = job_store.get(job_id)
+    if not job:
+        abort(404)
+    if job['status'] != 'done':
+        return "Отчет еще не готов", 409
+    if not job['file_path'] or not os.path.exists(job['file_path']):
+        return "Файл отчета больше не доступен", 410
+    standing_report = job['params'].get('standing_report')
+    download_name = f"{standing_report}_{job['params']['end_date']}.xlsx" if standing_report else 'profitability_report.xlsx'
+    return send_file(os.path.abspath(job['file_path']), as_attachment=True, download_name=download_name,
+                     mimetype=XLSX_MIMETYPE)
+
+@app.route('/standing_reports')
+def standing_reports():
+    # Постоянные отчеты с последней готовой книгой и возрастом ее данных
+    return jsonify(describe_standing_reports())
+
+@app.route('/api/report', methods=['GET', 'POST'])
+def report_api():
+    # Данные отчета без книги Excel для скриптов: ?format=json - страница строк (limit/offset),
+    # csv - потоковый CSV, parquet - файл Parquet. Параметры - как у формы отчета, столбцы - как на листе книги
+    # со всеми складами в соседних столбцах (раскладка складов и разбиение по группам не применяются)
+    export_format = request.values.get('format', REPORT_EXPORT_FORMATS[0])
+    if export_format not in REPORT_EXPORT_FORMATS:
+        return f"Неизвестный формат выгрузки: {export_format}", 400
+    try:
+        params = parse_report_form(request.values)
+    except (KeyError, ValueError) as e:
+        return f"Неверные параметры отчета: {str(e)}", 400
+    limit = max(min(request.values.get('limit', REPORT_PAGE_LIMIT, type=int), REPORT_PAGE_LIMIT), 0)
+    offset = max(request.values.get('offset', 0, type=int), 0)
+    
+    request_id = request.values.get('request_id') or uuid.uuid4().hex
+    token = register_cancel_token(request_id)
+    try:
+        report = load_report(params, token=token)
+        if report is None:
+            return "Нет данных для формирования отчета для выбранных параметров", 404
+        
+        store_ids = report_store_ids(params)
+        sheet = build_report_sheets(report['products_data'], store_ids, 'columns', params['planning_days'])[0]
+        manual_stock_by_group = get_manual_stock_by_group(params['manual_stock_settings'], get_group_index())
+        rows = iter_export_rows(sheet['products'], sheet['max_depth'], params['planning_days'], manual_stock_by_group,
+                                sheet['store_count'])
+        
+        if export_format == 'csv':
+            return Response(iter_csv(sheet['headers'], rows), mimetype='text/csv',
+                            headers={'Content-Disposition': 'attachment; filename=profitability_report.csv'})
+        if export_format == 'parquet':
+            return send_file(write_parquet(sheet['headers'], rows), as_attachment=True,
+                             download_name='profitability_report.parquet', mimetype='application/vnd.apache.parquet')
+        return jsonify({
+            'columns': sheet['headers'],
+            'total': len(sheet['products']),
+            'offset': offset,
+            'rows': list(itertools.islice(rows, offset, offset + limit))
+        })
+    except ProcessingCancelled as e:
+        return str(e), 499
+    except Exception as e:
+        logger.error(f"Error in report_api(): {str(e)}")
+        return f"Произошла ошибка при формировании отчета: {str(e)}", 500
+    finally:
+        logger.info(f"Метрики выгрузки {request_id}: {json.dumps(token.metrics.snapshot(), ensure_ascii=False)}")
+        release_cancel_token(request_id)
+
+def iter_csv(headers, rows):
+    # CSV по фрагментам из CSV_CHUNK_ROWS строк: ответ отдается по мере формирования, а не целиком
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(headers)
+    for chunk in itertools.batched(rows, CSV_CHUNK_ROWS):
+        writer.writerows(chunk)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+def write_parquet(headers, rows):
+    # Таблица Parquet по столбцам; как и книга Excel, большая держится во временном файле, а не в памяти.
+    # pyarrow импортируется только здесь: воркеры, не выгружающие Parquet, не тратят на него время и память
+    import pyarrow
+    import pyarrow.parquet
+    columns = [list(column) for column in zip(*rows)] or [[] for _ in headers]
+    table = pyarrow.table(columns, names=headers)
+    parquet_file = tempfile.SpooledTemporaryFile(max_size=EXCEL_SPOOL_MAX_SIZE)
+    pyarrow.parquet.write_table(table, parquet_file)
+    parquet_file.seek(0)
+    return parquet_file
 
 @app.route('/get_subgroups/<group_id>')
 def get_subgroups(group_id):
     subgroups = get_subgroups_for_group(group_id)
     return jsonify(subgroups)
 
+@app.route('/api/folders')
+def folders_api():
+    # Дерево групп по одному уровню: ?parent=<id> - дочерние группы (без parent - корневые),
+    # ?q=<начало названия> - поиск по всему дереву; limit/offset - постраничная выдача.
+    # Ответ с ETag: при неизменном дереве клиент получает 304 без тела
+    parent_id = request.args.get('parent', '')
+    prefix = request.args.get('q', '').strip()
+    limit = max(min(request.args.get('limit', FOLDER_PAGE_LIMIT, type=int), FOLDER_PAGE_LIMIT), 0)
+    offset = max(request.args.get('offset', 0, type=int), 0)
+    
+    if prefix:
+        folders = list(search_folders(prefix))
+    else:
+        folders = get_folder_level(parent_id)
+        if folders is None:
+            abort(404)
+    
+    group_index = get_group_index()
+    response = jsonify({
+        'total': len(folders),
+        'offset': offset,
+        'items': [describe_folder(group_index[folder['id']]) for folder in folders[offset:offset + limit]]
+    })
+    response.cache_control.no_cache = True
+    response.add_etag()
+    return response.make_conditional(request)
+
+@app.route('/metrics')
+def metrics_endpoint():
+    # Счетчики запросов к МойСклад и время этапов отчетов с момента запуска процесса
+    return jsonify(metrics.snapshot())
+
+@app.route('/refresh_reference_data', methods=['POST'])
+def refresh_reference_data():
+    # Явный сброс кэша справочников (например, после изменения групп в МойСклад)
+    reference_cache.invalidate(MOYSKLAD_TOKEN)
+    # Пути групп в сохраненных отчетах построены по старому дереву
+    report_cache.invalidate()
+    return '', 204
+
+@app.route('/refresh_turnover', methods=['POST'])
+def refresh_turnover():
+    # Полная перезагрузка истории операций склада (или всех складов) при следующем отчете
+    payload = request.get_json(silent=True) or {}
+    turnover_store.reset(payload.get('store_id') or request.form.get('store_id'))
+    report_cache.invalidate()
+    return '', 204
+
 @app.route('/stop_processing', methods=['POST'])
 def stop_processing():
-    global processing_cancelled
-    with processing_lock:
-        processing_cancelled = True
-    return '', 204
+    # Останавливаем только свой запрос или задание, а не все формирующиеся отчеты
+    payload = request.get_json(silent=True) or {}
+    job_id = payload.get('job_id') or request.form.get('job_id')
+    request_id = payload.get('request_id') or request.form.get('request_id')
+    
+    if job_id:
+        job = job_store.get(job_id)
+        if not job:
+            abort(404)
+        if not cancel_processing(job_id) and job['status'] in ('queued', 'running'):
+            # Задание еще в очереди или выполняется другим процессом - тот заметит статус при записи прогресса
+            job_store.update(job_id, status='cancelled', finished_at=time.time())
+        return '', 204
+    
+    if request_id and cancel_processing(request_id):
+        return '', 204
+    return "Не указано задание или запрос для остановки", 400
+
+def describe_job(job):
+    # Фаза, процент выполнения и оценка оставшегося времени для опроса из интерфейса
+    phase = job['phase'] or 'queued'
+    phase_title, phase_start, phase_end = REPORT_PHASES.get(phase, (phase, 0, 0))
+    percent = phase_start
+    if job['total']:
+        percent += (phase_end - phase_start) * min(job['done'], job['total']) / job['total']
+    if job['status'] == 'done':
+        percent = 100
 
-def check_if_cancelled():
-    global processing_cancelled
-    with processing_lock:
-        if processing_cancelled:
-            raise Exception("Processing cancelled by user")
+    eta_seconds = None
+    if job['status'] == 'running' and job['started_at'] and percent > 0:
+        elapsed = time.time() - job['started_at']
+        eta_seconds = round(elapsed * (100 - percent) / percent)
+
+    return {
+        'id': job['id'],
+        'status': job['status'],
+        'phase': phase,
+        'phase_title': phase_title,
+        'done': job['done'],
+        'total': job['total'],
+        'percent': round(percent, 1),
+        'eta_seconds': eta_seconds,
+        'error': job['error'],
+        'metrics': job['metrics'],
+        'created_at': job['created_at'],
+        'finished_at': job['finished_at'],
+        'file_url': url_for('job_file', job_id=job['id']) if job['status'] == 'done' else None
+    }
 
-def get_report_data(start_date, end_date, store_id, product_groups):
-    print(f"\nStarting get_report_data with product_groups: {product_groups}")  # Начало функции
+def run_report_job(job_id):
+    # Токен регистрируется до чтения задания: остановка после этого отменяет токен,
+    # а записанную раньше статус cancelled замечает условный запуск job_store.start
+    token = register_cancel_token(job_id)
+    job = job_store.get(job_id)
+    if not job or not job_store.start(job_id):
+        release_cancel_token(job_id)
+        job_locks.release(job_id)
+        return
     
-    global processing_cancelled
-    with processing_lock:
-        processing_cancelled = False
+    params = job['params']
+    tmp_filename = None
+    progress = JobProgress(job_id, token)
+    logger.info(f"Задание {job_id}: начало формирования отчета")
     
     try:
-        url = f"{BASE_URL}/report/profit/byvariant"
-        headers = {
-            'Authorization': f'Bearer {MOYSKLAD_TOKEN}',
-            'Accept': 'application/json;charset=utf-8',
-            'Content-Type': 'application/json'
-        }
-        
-        start_datetime = datetime.strptime(start_date, '%Y-%m-%d')
-        end_datetime = datetime.strptime(end_date, '%Y-%m-%d')
+        report = load_report(params, progress=progress, token=token)
         
-        formatted_start = start_datetime.strftime('%Y-%m-%d %H:%M:%S')
-        formatted_end = end_datetime.replace(hour=23, minute=59, second=59).strftime('%Y-%m-%d %H:%M:%S')
+        if report is None:
+            job_store.update(job_id, status='failed', finished_at=time.time(),
+                             error="Нет данных для формирования отчета для выбранных параметров")
+            return
         
-        params = {
-            'momentFrom': formatted_start,
-            'momentTo': formatted_end,
-            'limit': 1000,
-            'offset': 0
-        }
-        
-        filter_parts = []
+        standing_report = params.get('standing_report')
+        results_dir = STANDING_REPORTS_DIR if standing_report else JOBS_RESULTS_DIR
+        os.makedirs(results_dir, exist_ok=True)
+        filename = os.path.join(results_dir, f"report_{job_id}.xlsx")
+        # Книга пишется во временный файл и подменяет итоговый, чтобы не отдать недописанный отчет
+        tmp_filename = f"{filename}.tmp"
+        create_excel_report(None, report_store_ids(params), params['end_date'], params['planning_days'],
+                            params['manual_stock_settings'], progress=progress, filename=tmp_filename, token=token,
+                            products_data=report['products_data'], store_layout=params.get('store_layout', 'columns'),
+                            group_split=params.get('group_split', 'none'))
+        os.replace(tmp_filename, filename)
         
-        print(f"Building filter with product_groups: {product_groups}")  # Отладка
-        
-        # Добавляем фильтр по складу
-        if store_id:
-            store_url = f"{BASE_URL}/entity/store/{store_id}"
+        job_store.update(job_id, status='done', file_path=filename, finished_at=time.time())
+        if standing_report:
+            prune_standing_reports(standing_report, params.get('keep', STANDING_REPORTS_KEEP))
+        else:
+            prune_report_files(keep=filename)
+        logger.info(f"Задание {job_id}: отчет готов")
+    except ProcessingCancelled:
+        logger.info(f"Задание {job_id}: остановлено пользователем")
+        job_store.update(job_id, status='cancelled', finished_at=time.time())
+    except Exception as e:
+        logger.error(f"Задание {job_id}: ошибка {str(e)}")
+        job_store.update(job_id, status='failed', error=str(e), finished_at=time.time())
+    finally:
+        # Время этапов и запросы к API этого отчета сохраняются в задании при любом исходе
+        job_store.update(job_id, metrics=json.dumps(token.metrics.snapshot(), ensure_ascii=False))
+        release_cancel_token(job_id)
+        if tmp_filename and os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+        job_locks.release(job_id)
+
+def prune_report_files(keep=None):
+    # Очистка каталога готовых отчетов: удаляются файлы старше JOBS_RESULTS_MAX_AGE,
+    # затем самые старые, пока общий размер больше JOBS_RESULTS_MAX_BYTES. Файл keep не удаляется
+    if not os.path.isdir(JOBS_RESULTS_DIR):
+        return
+    now = time.time()
+    files = []
+    for entry in os.scandir(JOBS_RESULTS_DIR):
+        if not entry.is_file() or not entry.name.endswith('.xlsx'):
+            continue
+        stat = entry.stat()
+        files.append((stat.st_mtime, stat.st_size, entry.path))
+    files.sort()
+    
+    total_size = sum(size for _, size, _ in files)
+    keep = os.path.abspath(keep) if keep else None
+    for mtime, size, path in files:
+        if os.path.abspath(path) == keep:
+            continue
+        if now - mtime < JOBS_RESULTS_MAX_AGE and total_size <= JOBS_RESULTS_MAX_BYTES:
+            continue
+        try:
+            os.remove(path)
+            total_size -= size
+            logger.info(f"Удален файл отчета {path}")
+        except OSError as e:
+            logger.warning(f"Не удалось удалить файл отчета {path}: {str(e)}")
+
+def load_report(params, progress=None, token=None):
+    # Строки отчета прибыльности и данные товаров: из кэша результатов или из API с записью в кэш.
+    # None, если для выбранных параметров нет данных
+    key = ReportCache.key(MOYSKLAD_TOKEN, params)
+    if not params.get('force_refresh'):
+        report = report_cache.get(key)
+        if report is not None:
+            logger.info(f"Отчет взят из кэша результатов: {key}")
+            return report
+    
+    # Строки отчета прибыльности загружаются один раз сразу по всем складам, скорость продаж - по каждому складу.
+    # Страницы отчета переводятся в товары по мере загрузки, одновременно с загрузкой оборотов
+    store_ids = report_store_ids(params)
+    loaded_rows = 0
+    if progress:
+        progress = FetchProgress(progress)
+    
+    def report_pages():
+        nonlocal loaded_rows
+        for page in iter_report_pages(params['start_date'], params['end_date'], store_ids,
+                                      params['product_groups'], progress=progress, token=token):
+            loaded_rows += len(page['rows'])
+            yield page
+    
+    products_data = build_products_data(report_pages(), store_ids, params['end_date'], progress=progress, token=token)
+    if not loaded_rows:
+        return None
+    return report_cache.put(key, products_data)
+
+def resume_unfinished_jobs():
+    # Старые файлы отчетов удаляем и при запуске, а не только после новых заданий
+    prune_report_files()
+    # Задания, прерванные перезапуском процесса, запускаем заново с сохраненными параметрами.
+    # Задания, которые держит другой работающий процесс, пропускаются
+    for job_id in job_store.unfinished():
+        if not job_locks.acquire(job_id):
+            continue
+        logger.info(f"Возобновляем задание {job_id}")
+        report_executor.submit(run_report_job, job_id)
+
+CRON_FIELDS = (('минута', 0, 59), ('час', 0, 23), ('день месяца', 1, 31), ('месяц', 1, 12), ('день недели', 0, 7))
+
+def parse_cron(expression):
+    # Расписание в формате cron: "минута час день_месяца месяц день_недели", в каждом поле *, число,
+    # диапазон a-b, шаг */n или a-b/n и списки через запятую. День недели 0 или 7 - воскресенье
+    if not isinstance(expression, str):
+        raise ValueError(f"Расписание должно быть строкой: {expression!r}")
+    fields = expression.split()
+    if len(fields) != len(CRON_FIELDS):
+        raise ValueError(f"Расписание должно состоять из {len(CRON_FIELDS)} полей: {expression}")
+    result = []
+    for field, (title, low, high) in zip(fields, CRON_FIELDS):
+        values = set()
+        for part in field.split(','):
+            value_range, _, step = part.partition('/')
+            try:
+                if value_range == '*':
+                    start, end = low, high
+                elif '-' in value_range:
+                    start, end = (int(value) for value in value_range.split('-', 1))
+                else:
+                    start = end = int(value_range)
+                    if step:
+                        end = high
+                step = int(step) if step else 1
+            except ValueError:
+                raise ValueError(f"Неверное поле расписания ({title}): {field}") from None
+            if not low <= start <= end <= high or step < 1:
+                raise ValueError(f"Неверное поле расписания ({title}): {field}")
+            values.update(range(start, end + 1, step))
+        result.append(values)
+    # Ограничены ли день месяца и день недели: если оба, подходит любой из них, как в cron
+    result.append((fields[2] != '*', fields[4] != '*'))
+    return result
+
+def cron_matches(schedule, moment):
+    minutes, hours, days, months, weekdays, (days_restricted, weekdays_restricted) = schedule
+    if moment.minute not in minutes or moment.hour not in hours or moment.month not in months:
+        return False
+    weekday = (moment.weekday() + 1) % 7
+    day_matches = moment.day in days
+    weekday_matches = weekday in weekdays or (weekday == 0 and 7 in weekdays)
+    if days_restricted and weekdays_restricted:
+        return day_matches or weekday_matches
+    return day_matches and weekday_matches
+
+def load_standing_reports():
+    # Постоянные отчеты из STANDING_REPORTS_FILE - список объектов:
+    # {"name": "Утренний", "schedule": "0 6 * * 1-5", "store_ids": [...], "product_groups": [...],
+    #  "store_layout": "columns", "group_split": "none", "planning_days": 30, "period_days": 30,
+    #  "manual_stock_settings": [...], "keep": 7}.
+    # Период отчета - period_days полных дней до дня запуска. Отчеты с ошибками в настройках пропускаются
+    if not STANDING_REPORTS_FILE or not os.path.exists(STANDING_REPORTS_FILE):
+        return []
+    try:
+        with open(STANDING_REPORTS_FILE, 'r', encoding='utf-8') as config_file:
+            entries = json.load(config_file)
+    except (OSError, ValueError) as e:
+        logger.warning(f"Не удалось прочитать настройки постоянных отчетов {STANDING_REPORTS_FILE}: {str(e)}")
+        return []
+    if not isinstance(entries, list):
+        logger.warning(f"Настройки постоянных отчетов {STANDING_REPORTS_FILE} должны быть списком объектов")
+        return []
+
+    reports = []
+    names = set()
+    for entry in entries:
+        if not isinstance(entry, dict):
+            logger.warning(f"Постоянный отчет {entry!r} пропущен: ожидается объект")
+            continue
+        try:
+            params = report_options(entry['store_ids'], entry.get('store_layout'), entry.get('group_split'),
+                                    entry.get('product_groups'), entry.get('manual_stock_settings'))
+            params['planning_days'] = int(entry.get('planning_days', 30))
+            report = {
+                'name': str(entry['name']),
+                'schedule': entry['schedule'],
+                'cron': parse_cron(entry['schedule']),
+                'period_days': int(entry.get('period_days', 30)),
+                'keep': int(entry.get('keep', STANDING_REPORTS_KEEP)),
+                'params': params
+            }
+            if report['period_days'] < 1 or report['keep'] < 1:
+                raise ValueError("period_days и keep должны быть положительными")
+            if report['name'] in names:
+                raise ValueError("Повторяющееся название")
+        except (KeyError, TypeError, ValueError) as e:
+            logger.warning(f"Постоянный отчет {entry.get('name')} пропущен: {str(e)}")
+            continue
+        names.add(report['name'])
+        reports.append(report)
+    return reports
+
+def submit_standing_report(report, moment):
+    # Задание постоянного отчета за period_days полных дней до moment. Пропускается, если прошлый запуск не закончен
+    jobs = job_store.standing_jobs(report['name'])
+    if any(job['status'] in ('queued', 'running') for job in jobs):
+        logger.info(f"Постоянный отчет {report['name']}: прошлое задание еще выполняется")
+        return None
+    end_date = moment.date() - timedelta(days=1)
+    params = dict(report['params'],
+                  start_date=(end_date - timedelta(days=report['period_days'] - 1)).isoformat(),
+                  end_date=end_date.isoformat(),
+                  standing_report=report['name'],
+                  keep=report['keep'],
+                  force_refresh=True)
+    job_id = job_store.create(params)
+    job_locks.acquire(job_id)
+    report_executor.submit(run_report_job, job_id)
+    logger.info(f"Постоянный отчет {report['name']}: создано задание {job_id}")
+    return job_id
+
+def run_standing_reports_periodically():
+    # Раз в минуту запускает постоянные отчеты, расписание которых совпало с текущей минутой.
+    # Настройки читаются заново, поэтому правка файла не требует перезапуска
+    # Ошибка в настройках или базе заданий пропускает только эту минуту, а не останавливает расписание
+    while True:
+        moment = datetime.now().replace(second=0, microsecond=0)
+        try:
+            reports = load_standing_reports()
+        except Exception as e:
+            logger.warning(f"Не удалось загрузить постоянные отчеты: {str(e)}")
+            reports = []
+        for report in reports:
+            if cron_matches(report['cron'], moment):
+                try:
+                    submit_standing_report(report, moment)
+                except Exception as e:
+                    logger.warning(f"Постоянный отчет {report['name']} не запущен: {str(e)}")
+        time.sleep(60 - time.time() % 60)
+
+def start_standing_reports():
+    # Расписание ведет один процесс из воркеров WSGI-сервера - тот, что первым взял блокировку
+    if not STANDING_REPORTS_FILE or not job_locks.acquire('standing_reports'):
+        return
+    threading.Thread(target=run_standing_reports_periodically, name='standing-reports', daemon=True).start()
+
+def prune_standing_reports(name, keep):
+    # Хранятся книги keep последних готовых запусков постоянного отчета, файлы более старых удаляются
+    finished = [job for job in job_store.standing_jobs(name) if job['status'] == 'done' and job['file_path']]
+    for job in finished[keep:]:
+        if not os.path.exists(job['file_path']):
+            continue
+        try:
+            os.remove(job['file_path'])
+            logger.info(f"Удален файл постоянного отчета {job['file_path']}")
+        except OSError as e:
+            logger.warning(f"Не удалось удалить файл постоянного отчета {job['file_path']}: {str(e)}")
+
+def format_age(seconds):
+    # Возраст данных отчета для страницы: "15 мин", "3 ч 20 мин", "2 дн 4 ч"
+    minutes = seconds // 60
+    if minutes < 60:
+        return f"{minutes} мин"
+    hours, minutes = divmod(minutes, 60)
+    if hours < 24:
+        return f"{hours} ч {minutes} мин"
+    days, hours = divmod(hours, 24)
+    return f"{days} дн {hours} ч"
+
+def describe_standing_reports():
+    # Последняя готовая книга каждого постоянного отчета и возраст ее данных для страницы и /standing_reports
+    now = time.time()
+    result = []
+    for report in load_standing_reports():
+        jobs = job_store.standing_jobs(report['name'])
+        latest = next((job for job in jobs if job['status'] == 'done'
+                       and job['file_path'] and os.path.exists(job['file_path'])), None)
+        result.append({
+            'name': report['name'],
+            'schedule': report['schedule'],
+            'running': any(job['status'] in ('queued', 'running') for job in jobs),
+            'start_date': latest['params']['start_date'] if latest else None,
+            'end_date': latest['params']['end_date'] if latest else None,
+            'finished_at': latest['finished_at'] if latest else None,
+            'age_seconds': round(now - latest['finished_at']) if latest else None,
+            'file_url': url_for('job_file', job_id=latest['id']) if latest else None
+        })
+    return result
+
+@dataclass(slots=True)
+class ReportRow:
+    # Строка отчета прибыльности: только нужные отчету поля, без вложенных meta
+    assortment_id: str
+    is_variant: bool
+    name: str
+    sell_quantity: float
+    profit: float  # в копейках, как в API
+
+def project_report_row(row):
+    # Сокращает строку /report/profit/byvariant до ReportRow сразу после разбора страницы.
+    # None - строка без товара или модификации, в отчет не попадает
+    assortment = row.get('assortment', {})
+    assortment_href = assortment.get('meta', {}).get('href', '')
+    
+    is_variant = '/variant/' in assortment_href
+    assortment_id = assortment_href.split('/variant/')[-1] if is_variant else assortment_href.split('/product/')[-1]
+    if not assortment_id:
+        return None
+    return ReportRow(assortment_id, is_variant, assortment.get('name', ''), row.get('sellQuantity', 0),
+                     row.get('profit', 0))
+
+def iter_report_pages(start_date, end_date, store_id, product_groups, progress=None, token=None):
+    # Страницы отчета прибыльности ({'meta', 'rows'} со строками ReportRow) по мере загрузки.
+    # store_id - склад или список складов: по нескольким складам отчет считается суммарно
+    logger.debug(f"Starting iter_report_pages with product_groups: {product_groups}")  # Начало функции
+
+    url = f"{BASE_URL}/report/profit/byvariant"
+    
+    start_datetime = datetime.strptime(start_date, '%Y-%m-%d')
+    end_datetime = datetime.strptime(end_date, '%Y-%m-%d')
+    
+    formatted_start = start_datetime.strftime('%Y-%m-%d %H:%M:%S')
+    formatted_end = end_datetime.replace(hour=23, minute=59, second=59).strftime('%Y-%m-%d %H:%M:%S')
+    
+    params = {
+        'momentFrom': formatted_start,
+        'momentTo': formatted_end
+    }
+    
+    filter_parts = []
+    
+    logger.debug(f"Building filter with product_groups: {product_groups}")  # Отладка
+    
+    # Добавляем фильтр по складу (повтор фильтра по нескольким складам объединяется в API по "или")
+    store_ids = [store_id] if isinstance(store_id, str) else store_id
+    for store in store_ids or []:
+        if store:
+            store_url = f"{BASE_URL}/entity/store/{store}"
             store_filter = f'store={store_url}'
             filter_parts.append(store_filter)
-            print(f"Added store filter: {store_filter}")  # Отладка
-        
-        # Формируем фильтр по группам
-        if product_groups:
-            product_folder_parts = []
-            for group_id in product_groups:
-                if group_id:  # Проверяем, что group_id не пустой
-                    product_folder_url = f"{BASE_URL}/entity/productfolder/{group_id}"
-                    product_folder_parts.append(product_folder_url)
-                    print(f"Added group URL: {product_folder_url}")  # Отладка
-            
-            if product_folder_parts:
-                # Формируем фильтр по группам через точку с запятой (;)
-                folders_filter = '&filter='.join([f'productFolder={url}' for url in product_folder_parts])
-                filter_parts.append(folders_filter)
-                print(f"Combined group filters: {folders_filter}")  # Отладка
-        
-        if filter_parts:
-            # Объединяем все части фильтра через запятую (И)
-            params['filter'] = '&filter='.join(filter_parts)
-            print(f"Final filter parameter: {params['filter']}")  # Отладка
-        
-        all_rows = []
-        total_count = None
-        
+            logger.debug(f"Added store filter: {store_filter}")  # Отладка
+    
+    # Формируем фильтр по группам
+    if product_groups:
+        for group_id in product_groups:
+            if group_id:  # Проверяем, что group_id не пустой
+                product_folder_url = f"{BASE_URL}/entity/productfolder/{group_id}"
+                filter_parts.append(f'productFolder={product_folder_url}')
+                logger.debug(f"Added group URL: {product_folder_url}")  # Отладка
+    
+    logger.debug(f"Final filter parameters: {filter_parts}")  # Отладка
+    
+    # Страницы после первой загружаются параллельно
+    def on_page(loaded, total):
+        if progress:
+            progress('fetch_report', loaded, total)
+    
+    pages = moysklad.iter_pages(url, params, filter_parts, limit=1000, token=token, on_page=on_page,
+                                project=project_report_row)
+    # Время этапа - только ожидание страниц, без обработки их потребителем
+    fetch_seconds = 0
+    try:
         while True:
-            check_if_cancelled()
-            
-            query_params = [f"{k}={v}" for k, v in params.items() if k != 'filter']
-            if 'filter' in params:
-                query_params.append(f"filter={params['filter']}")
-            query_string = '&'.join(query_params)
-            
-            full_url = f"{url}?{query_string}"
-            print(f"Отправляем запрос: URL={full_url}, Headers={headers}")
-            
-            response = requests.get(full_url, headers=headers)
-            
-            if response.status_code != 200:
-                error_message = f"Ошибка при получении данных: {response.status_code}. Ответ сервера: {response.text}"
-                print(error_message)
-                raise Exception(error_message)
-            
-            data = response.json()
-            
-            if total_count is None:
-                total_count = data.get('meta', {}).get('size', 0)
-                print(f"Всего записей: {total_count}")
-            
-            all_rows.extend(data.get('rows', []))
-            
-            if len(all_rows) >= total_count:
-                break
-            
-            params['offset'] += params['limit']
-        
-        return {'meta': data.get('meta', {}), 'rows': all_rows}
-        
-    except Exception as e:
-        if str(e) == "Processing cancelled by user":
-            abort(499, description="Processing cancelled by user")
-        raise e
+            started = time.perf_counter()
+            page = next(pages, None)
+            fetch_seconds += time.perf_counter() - started
+            if page is None:
+                return
+            yield page
+    finally:
+        pages.close()
+        record_phase('fetch_report', fetch_seconds, token)
+
+def get_report_data(start_date, end_date, store_id, product_groups, progress=None, token=None):
+    # Все строки отчета прибыльности сразу: {'meta', 'rows'}
+    meta, rows = None, []
+    for page in iter_report_pages(start_date, end_date, store_id, product_groups, progress, token):
+        if meta is None:
+            meta = page.get('meta', {})
+        rows.extend(page['rows'])
+    return {'meta': meta or {}, 'rows': rows}
 
 def get_stores():
+    return reference_cache.get(MOYSKLAD_TOKEN, 'stores', fetch_stores)
+
+def fetch_stores():
     url = f"{BASE_URL}/entity/store"
-    headers = {
-        'Authorization': f'Bearer {MOYSKLAD_TOKEN}',
-        'Accept': 'application/json;charset=utf-8'
-    }
     
-    print(f"Отправляем запрос для полуения списка складов: URL={url}, Headers={headers}")  # Для отладки
+    logger.debug(f"Отправляем запрос для полуения списка складов: URL={url}")  # Для отладки
     
-    response = requests.get(url, headers=headers)
-    if response.status_code == 200:
-        stores = response.json()['rows']
-        return [{'id': store['id'], 'name': store['name']} for store in stores]
-    else:
-        error_message = f"Ошибка пр�� получении списка складов: {response.status_code}. Ответ сервера: {response.text}"
-        print(error_message)  # Выводим ошибку в консоль для отладки
+    try:
+        _, stores = moysklad.get_all_rows(url)
+    except Exception as e:
+        error_message = f"Ошибка пр�� получении списка складов: {str(e)}"
+        logger.error(error_message)  # Выводим ошибку в консоль для отладки
         raise Exception(error_message)
+    return [{'id': store['id'], 'name': store['name']} for store in stores]
     
-def get_subgroups_for_group(group_id):
-    url = f"{BASE_URL}/entity/productfolder"
-    headers = {
-        'Authorization': f'Bearer {MOYSKLAD_TOKEN}',
-        'Accept': 'application/json;charset=utf-8'
+def describe_folder(entry):
+    node = entry['node']
+    return {
+        'id': node['id'],
+        'name': node['name'],
+        'path': '/'.join(entry['name_path']),
+        'has_children': bool(node['children'])
     }
-    params = {
-        'filter': f'productFolder={group_id}'
-    }
-    
-    response = requests.get(url, headers=headers, params=params)
-    if response.status_code == 200:
-        subgroups = response.json()['rows']
-        return [{'id': group['id'], 'name': group['name'], 'children': []} for group in subgroups]
-    else:
-        error_message = f"Ошибка при получении подгрупп: {response.status_code}. Ответ сервера: {response.text}"
-        print(error_message)
+
+def get_subgroups_for_group(group_id):
+    # Дочерние группы из кэшированного дерева, без запроса к API
+    entry = get_group_index().get(group_id)
+    if not entry:
         return []
+    return [{'id': child['id'], 'name': child['name'], 'children': []} for child in entry['node']['children']]
+
+def get_folder_level(parent_id=None):
+    # Один уровень дерева групп: корневые группы или дочерние группы parent_id. None, если группы нет
+    if not parent_id:
+        return get_product_groups()
+    entry = get_group_index().get(parent_id)
+    return entry['node']['children'] if entry else None
+
+def search_folders(prefix):
+    # Группы, название которых начинается с prefix (без учета регистра), в алфавитном порядке
+    _, group_index, name_index = get_folder_tree()
+    prefix = prefix.casefold()
+    start = bisect.bisect_left(name_index, (prefix, ''))
+    for name, group_id in itertools.islice(name_index, start, None):
+        if not name.startswith(prefix):
+            break
+        yield group_index[group_id]['node']
+
+def get_folder_tree():
+    # Корневые группы, плоский индекс групп и отсортированный список имен для поиска по префиксу
+    return reference_cache.get(MOYSKLAD_TOKEN, 'product_folders', fetch_product_folders, build_group_hierarchy)
 
 def get_product_groups():
+    root_groups, _, _ = get_folder_tree()
+    return root_groups
+
+def get_group_index():
+    _, group_index, _ = get_folder_tree()
+    return group_index
+
+def fetch_product_folders():
     url = f"{BASE_URL}/entity/productfolder"
-    headers = {
-        'Authorization': f'Bearer {MOYSKLAD_TOKEN}',
-        'Accept': 'application/json;charset=utf-8'
-    }
     
-    all_groups = []
-    offset = 0
-    limit = 1000
+    try:
+        _, all_groups = moysklad.get_all_rows(url)
+    except Exception as e:
+        error_message = f"Ошибка при получении ска групп товаров: {str(e)}"
+        logger.error(error_message)
+        raise Exception(error_message)
 
-    while True:
-        params = {
-            'offset': offset,
-            'limit': limit
+    # В кэше храним только поля, нужные для построения иерархии
+    return [
+        {
+            'id': group['id'],
+            'name': group['name'],
+            'productFolder': {'meta': {'href': group.get('productFolder', {}).get('meta', {}).get('href')}}
         }
-        
-        response = requests.get(url, headers=headers, params=params)
-        if response.status_code == 200:
-            data = response.json()
-            all_groups.extend(data['rows'])
-            if len(data['rows']) < limit:
-                break
-            offset += limit
-        else:
-            error_message = f"Ошибка при получении ска групп товаров: {response.status_code}. Ответ сервера: {response.text}"
-            print(error_message)
-            raise Exception(error_message)
-
-    return build_group_hierarchy(all_groups)
+        for group in all_groups
+    ]
 
 def build_group_hierarchy(groups):
     group_dict = {}
@@ -290,7 +1945,27 @@ def build_group_hierarchy(groups):
     for group in group_dict.values():
         group['children'].sort(key=lambda x: x['name'])
 
-    return root_groups
+    # Плоский индекс: id -> узел, родитель, глубина и готовые пути имен и UUID,
+    # чтобы поиск пути группы был обращением к словарю, а не обходом дерева
+    group_index = {}
+    stack = [(group, [], []) for group in reversed(root_groups)]
+    while stack:
+        group, parent_names, parent_uuids = stack.pop()
+        name_path = parent_names + [group['name']]
+        uuid_path = parent_uuids + [group['id']]
+        group_index[group['id']] = {
+            'node': group,
+            'parent': group['parent'],
+            'depth': len(uuid_path),
+            'name_path': name_path,
+            'uuid_path': uuid_path
+        }
+        stack.extend((child, name_path, uuid_path) for child in reversed(group['children']))
+
+    # Имена в нижнем регистре, отсортированные для поиска групп по началу названия
+    name_index = sorted((group['name'].casefold(), group['id']) for group in group_dict.values())
+
+    return root_groups, group_index, name_index
 
 # Добавьте эту функцию для отладки
 def print_group_hierarchy(groups, level=0):
@@ -298,46 +1973,229 @@ def print_group_hierarchy(groups, level=0):
         print("  " * level + f"{group['name']} (ID: {group['id']})")
         print_group_hierarchy(group['children'], level + 1)
 
-def get_sales_speed(variant_id, store_id, end_date, is_variant):
+def fetch_turnover_operations(params, filters, token=None, on_page=None):
+    # Все страницы turnover/byoperations по limit/offset, строки сразу сокращаются до TurnoverOperation.
+    # Товар и группа приходят в строке отчета, поэтому expand не нужен
     url = f"{BASE_URL}/report/turnover/byoperations"
-    headers = {
-        'Authorization': f'Bearer {MOYSKLAD_TOKEN}',
-        'Accept': 'application/json;charset=utf-8'
-    }
-    
-    start_date = "2024-01-01 00:00:00"
+    return moysklad.get_all_rows(url, params, filters, limit=TURNOVER_PAGE_LIMIT, token=token, on_page=on_page,
+                                 project=project_turnover_row)
+
+def get_sales_speed(variant_id, store_id, end_date, is_variant, token=None):
     end_date_formatted = datetime.strptime(end_date, '%Y-%m-%d').strftime('%Y-%m-%d 23:59:59')
     
     assortment_type = 'variant' if is_variant else 'product'
     
-    filter_params = [
-        f"filter=store={BASE_URL}/entity/store/{store_id}",
-        f"filter={assortment_type}={BASE_URL}/entity/{assortment_type}/{variant_id}"
+    filters = [
+        f"store={BASE_URL}/entity/store/{store_id}",
+        f"{assortment_type}={BASE_URL}/entity/{assortment_type}/{variant_id}"
     ]
     
     params = {
-        'momentFrom': start_date,
+        'momentFrom': SALES_HISTORY_START,
         'momentTo': end_date_formatted,
     }
     
-    query_string = '&'.join([f"{k}={v}" for k, v in params.items()] + filter_params)
-    full_url = f"{url}?{query_string}"
+    logger.debug("Запрос для получения данных о продажах: %s %s", assortment_type, variant_id)
     
-    print(f"Запрос для получения данных о родажах: URL={full_url}")
-    
-    response = requests.get(full_url, headers=headers)
-    if response.status_code != 200:
-        print(f"Ошибка пи получении данных о проажах: {response.status_code}. Ответ ервера: {response.text}")
-        return 0, '', '', '', ''  # Возвращаем 0 для скоости и пустую строку для UUID
+    # Все страницы операций товара: у товаров с большим оборотом операций больше одной страницы
+    try:
+        _, operations = fetch_turnover_operations(params, filters, token=token)
+    except ProcessingCancelled:
+        raise
+    except Exception as e:
+        logger.warning(f"Ошибка при получении данных о продажах: {str(e)}")
+        return NO_SALES_SPEED  # Нулевая скорость и пустые группа и ссылка на товар
 
-    data = response.json()
-    rows = data.get('rows', [])
+    return calculate_sales_speed(variant_id, operations, end_date)
 
-    # Фильтрация по UUID модификации
-    filtered_rows = [
-        row for row in rows
-        if row.get('assortment', {}).get('meta', {}).get('href', '').split('/')[-1] == variant_id
-    ]
+def get_assortment_id(row):
+    return row.get('assortment', {}).get('meta', {}).get('href', '').split('/')[-1]
+
+def sync_store_turnover(store_id, progress=None, token=None):
+    # Догружает в turnover_store операции склада, появившиеся после прошлой синхронизации.
+    # Первая синхронизация загружает историю с SALES_HISTORY_START. Если отметка изменилась во время
+    # загрузки (сброс истории, синхронизация в другом процессе), загрузка повторяется от новой отметки
+    with turnover_store.sync_lock(store_id):
+        while True:
+            synced_to = turnover_store.synced_to(store_id)
+            if synced_to:
+                moment_from = (datetime.strptime(synced_to, TurnoverStore.MOMENT_FORMAT)
+                               - timedelta(hours=TURNOVER_RESYNC_HOURS)).strftime(TurnoverStore.MOMENT_FORMAT)
+                moment_from = max(moment_from, SALES_HISTORY_START)
+            else:
+                moment_from = SALES_HISTORY_START
+            moment_to = datetime.now().strftime(TurnoverStore.MOMENT_FORMAT)
+            # Дневные итоги пересчитываются с дня moment_from, а если их еще нет (хранилище старой версии) - за всю историю
+            day_from = moment_from[:10] if turnover_store.has_daily(store_id) else SALES_HISTORY_START[:10]
+
+            params = {
+                'momentFrom': moment_from,
+                'momentTo': moment_to
+            }
+            filters = [f"store={BASE_URL}/entity/store/{store_id}"]
+
+            def on_page(loaded, total):
+                if progress:
+                    progress('fetch_turnover', loaded, total)
+
+            logger.info(f"Синхронизация оборотов склада {store_id} с {moment_from}")
+            try:
+                with timed_phase('fetch_turnover', token):
+                    _, operations = fetch_turnover_operations(params, filters, token=token, on_page=on_page)
+                    turnover_store.replace_since(store_id, moment_from, operations, moment_to, day_from,
+                                                 expected_synced_to=synced_to)
+            except TurnoverSyncConflict as e:
+                logger.info(f"{str(e)}, синхронизация начинается заново")
+                continue
+            logger.info(f"Загружено новых операций: {len(operations)}")
+            return
+
+def refresh_turnover_periodically():
+    # Плановое обновление: догрузка операций и дневных итогов складов, по которым уже строились отчеты,
+    # чтобы отчету оставалось догрузить только операции последних минут
+    while True:
+        for store_id in turnover_store.store_ids():
+            try:
+                sync_store_turnover(store_id)
+            except Exception as e:
+                logger.warning(f"Ошибка планового обновления оборотов склада {store_id}: {str(e)}")
+        time.sleep(TURNOVER_REFRESH_INTERVAL)
+
+def start_turnover_refresh():
+    # Плановое обновление ведет один процесс из воркеров WSGI-сервера - тот, что первым взял блокировку
+    if not TURNOVER_REFRESH_INTERVAL or not job_locks.acquire('turnover_refresh'):
+        return
+    threading.Thread(target=refresh_turnover_periodically, name='turnover-refresh', daemon=True).start()
+
+# Скорость продаж всех товаров склада по дневным итогам из локального хранилища
+# (после догрузки новых операций из API): словарь {UUID товара/модификации: результат как у calculate_sales_speed}.
+# None, если синхронизация не удалась (тогда используется get_sales_speed по одному товару).
+def get_sales_speeds(store_id, end_date, progress=None, token=None):
+    try:
+        sync_store_turnover(store_id, progress, token)
+    except ProcessingCancelled:
+        raise
+    except Exception as e:
+        logger.warning(f"Ошибка при пакетной загрузке оборотов: {str(e)}")
+        return None
+
+    with timed_phase('sales_speed', token):
+        columns, assortment_info = turnover_store.daily_columns(store_id, end_date)
+        check_cancelled(token)
+        speeds = calculate_period_sales_speeds(columns['assortment_id'], columns['day'], columns['sold'],
+                                               columns['on_stock_us'], columns['closing_stock'], np.datetime64(end_date, 'D'))
+    logger.info(f"Дневных итогов по складу: {len(columns['assortment_id'])}, товаров: {len(speeds)}")
+
+    result = {}
+    for assortment_id, speed in speeds.items():
+        assortment_href, uuid_href, folder_href, folder_name = assortment_info.get(assortment_id, ('', '', '', ''))
+        group_uuid = folder_href.split('/')[-1] if folder_href else ''
+        product_uuid = assortment_href.split('/')[-1] if uuid_href else ''
+        result[assortment_id] = (speed, group_uuid, folder_name or '', product_uuid, uuid_href or '')
+    return result
+
+def calculate_daily_turnover(assortment_ids, moments, quantities, is_retaildemand, opening_stock):
+    # Дневные итоги по операциям многих товаров сразу, те же правила, что в calculate_sales_speed:
+    # остаток не уходит ниже нуля, время "в наличии" - интервалы между операциями при положительном остатке
+    # (интервал, переходящий через полночь, делится между днями), продажи - расход по розничным продажам.
+    # opening_stock - {товар: остаток на начало первого дня}. Количество считается в целых единицах QUANTITY_SCALE,
+    # чтобы остаток и его сравнение с нулем были точными. Результат - строки
+    # (товар, день 'YYYY-MM-DD', продано, в наличии мкс, остаток на конец дня) только для дней с операциями
+    if len(assortment_ids) == 0:
+        return []
+
+    ids, codes = np.unique(assortment_ids, return_inverse=True)
+    # Устойчивая сортировка по товару, затем по времени операции - как sort в calculate_sales_speed
+    order = np.lexsort((moments, codes))
+    codes = codes[order]
+    timestamps = moments[order].astype(np.int64)
+    quantities = np.rint(quantities[order] * QUANTITY_SCALE).astype(np.int64)
+    is_retaildemand = is_retaildemand[order]
+    days = timestamps // DAY_US
+
+    count = len(codes)
+    starts = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]])
+    group_sizes = np.diff(np.r_[starts, count])
+    group_of_row = np.repeat(np.arange(len(starts)), group_sizes)
+    opening = np.array([opening_stock.get(assortment_id, 0) for assortment_id in ids[codes[starts]]], dtype=np.int64)
+
+    # Остаток с ограничением снизу нулем: s_i = c_i - min(0, min(c_1..c_i)), где c - начальный остаток
+    # плюс накопленная сумма в группе
+    totals = np.cumsum(quantities)
+    cumulative = totals - np.r_[0, totals][starts][group_of_row] + opening[group_of_row]
+    # Накопленный минимум по группам: сдвиг каждой следующей группы ниже всех предыдущих
+    shift = 2 * int(np.abs(cumulative).max()) + 1
+    offsets = group_of_row.astype(np.int64) * shift
+    running_min = np.minimum.accumulate(cumulative - offsets) + offsets
+    stock = cumulative - np.minimum(running_min, 0)
+    previous_stock = np.r_[0, stock[:-1]]
+    previous_stock[starts] = opening
+
+    # Интервал до следующей операции товара в тот же день (для последней операции дня - до полуночи)
+    # учитывается, если остаток > 0, и время от начала дня до первой операции - если товар был в наличии
+    day_starts = np.flatnonzero(np.r_[True, (codes[1:] != codes[:-1]) | (days[1:] != days[:-1])])
+    day_ends = np.r_[day_starts[1:], count] - 1
+    next_timestamps = np.r_[timestamps[1:], 0]
+    next_timestamps[day_ends] = (days[day_ends] + 1) * DAY_US
+    on_stock_us = np.where(stock > 0, next_timestamps - timestamps, 0)
+    on_stock_us = np.add.reduceat(on_stock_us, day_starts)
+    on_stock_us += np.where(previous_stock[day_starts] > 0, timestamps[day_starts] - days[day_starts] * DAY_US, 0)
+
+    retail_sold = np.where(is_retaildemand & (quantities <= 0), -quantities, 0)
+    retail_sold = np.add.reduceat(retail_sold, day_starts)
+
+    return list(zip(
+        ids[codes[day_starts]].tolist(),
+        days[day_starts].astype('datetime64[D]').astype(str).tolist(),
+        retail_sold.tolist(),
+        on_stock_us.tolist(),
+        stock[day_ends].tolist()
+    ))
+
+def calculate_period_sales_speeds(assortment_ids, days, sold, on_stock_us, closing_stock, end_day, start_day=None):
+    # Скорость продаж за период по дневным итогам calculate_daily_turnover (строки отсортированы по товару и дню,
+    # дни не позже end_day): суммы продаж и времени в наличии по дням периода. Дни без операций между строками
+    # товара целиком в наличии, если остаток на конец предыдущего дня положительный. Период заканчивается
+    # в 23:59:59 end_day, как в calculate_sales_speed; start_day - начало периода (None - вся история)
+    if len(assortment_ids) == 0:
+        return {}
+
+    days = days.astype('datetime64[D]').astype(np.int64)
+    end_day = np.datetime64(end_day, 'D').astype(np.int64)
+    count = len(days)
+    starts = np.flatnonzero(np.r_[True, assortment_ids[1:] != assortment_ids[:-1]])
+    ends = np.r_[starts[1:], count] - 1
+
+    # Дни без операций: от следующего за строкой дня до дня следующей строки (для последней - до конца периода)
+    next_days = np.r_[days[1:], 0]
+    next_days[ends] = end_day + 1
+    gap_from = days + 1
+    if start_day is not None:
+        start_day = np.datetime64(start_day, 'D').astype(np.int64)
+        gap_from = np.maximum(gap_from, start_day)
+        in_period = days >= start_day
+        sold = np.where(in_period, sold, 0)
+        on_stock_us = np.where(in_period, on_stock_us, 0)
+    gap_days = np.maximum(np.minimum(next_days, end_day + 1) - gap_from, 0)
+    on_stock_us = on_stock_us + np.where(closing_stock > 0, gap_days * DAY_US, 0)
+
+    on_stock_us = np.add.reduceat(on_stock_us, starts)
+    # Последняя секунда end_day за пределами периода
+    on_stock_us -= np.where(closing_stock[ends] > 0, 10 ** 6, 0)
+    sold = np.add.reduceat(sold, starts)
+
+    speeds = {}
+    for assortment_id, retail_sold, stock_us in zip(assortment_ids[starts], sold.tolist(), on_stock_us.tolist()):
+        days_on_stock = stock_us / 10 ** 6 / (24 * 60 * 60)
+        speeds[assortment_id] = round(retail_sold / QUANTITY_SCALE / days_on_stock, 2) if days_on_stock > 0 else 0
+    return speeds
+
+def calculate_sales_speed(variant_id, operations, end_date):
+    # operations - операции TurnoverOperation. Фильтр по товару в API возвращает и операции его модификаций,
+    # поэтому оставляем только операции самого товара или модификации
+    end_date_formatted = datetime.strptime(end_date, '%Y-%m-%d').strftime('%Y-%m-%d 23:59:59')
+
+    filtered_rows = [operation for operation in operations if operation.assortment_id == variant_id]
 
     # Получаем UUID группы и название группы из отфильтрованных данных
     group_uuid = ''
@@ -346,22 +2204,23 @@ def get_sales_speed(variant_id, store_id, end_date, is_variant):
     product_href = ''
     
     if filtered_rows:
-        assortment = filtered_rows[0].get('assortment', {})
-        product_folder = assortment.get('productFolder', {})
-        group_href = product_folder.get('meta', {}).get('href', '')
+        first_operation = filtered_rows[0]
+        group_href = first_operation.folder_href
         group_uuid = group_href.split('/')[-1] if group_href else ''
-        group_name = product_folder.get('name', '')
+        group_name = first_operation.folder_name
         
         # Получаем UUID сылку на товар из отфильтрованной строки
-        product_meta = assortment.get('meta', {})
-        product_href = product_meta.get('uuidHref', '')
+        product_href = first_operation.uuid_href
         if product_href:
-            product_uuid = product_meta.get('href', '').split('/')[-1]
+            product_uuid = first_operation.assortment_href.split('/')[-1]
         
-        print(f"Found group UUID: {group_uuid}, name: {group_name}")
+        logger.debug("Found group UUID: %s, name: %s", group_uuid, group_name)
 
-    # Сортировка оперций по дате
-    filtered_rows.sort(key=lambda x: datetime.fromisoformat(x['operation']['moment'].replace('Z', '+00:00')))
+    # Сортировка оперций по дате (время каждой операции разбирается один раз)
+    operations = sorted(
+        ((datetime.fromisoformat(row.moment.replace('Z', '+00:00')), row) for row in filtered_rows),
+        key=lambda operation: operation[0]
+    )
 
     retail_demand_counter = 0
     current_stock = 0
@@ -370,10 +2229,9 @@ def get_sales_speed(variant_id, store_id, end_date, is_variant):
 
     end_datetime = datetime.strptime(end_date_formatted, '%Y-%m-%d %H:%M:%S')
 
-    for row in filtered_rows:
-        quantity = row['quantity']
-        operation_time = datetime.fromisoformat(row['operation']['moment'].replace('Z', '+00:00'))
-        operation_type = row['operation']['meta']['type']
+    for operation_time, row in operations:
+        quantity = row.quantity
+        operation_type = row.operation_type
 
         if last_operation_time and current_stock > 0:
             on_stock_time += operation_time - last_operation_time
@@ -399,35 +2257,62 @@ def get_sales_speed(variant_id, store_id, end_date, is_variant):
     else:
         sales_speed = 0
 
-    print(f"sales_speed: {sales_speed}, group_uuid: {group_uuid}, product_href: {product_href}")
+    logger.debug("sales_speed: %s, group_uuid: %s, product_href: %s", sales_speed, group_uuid, product_href)
 
     return sales_speed, group_uuid, group_name, product_uuid, product_href
 
-def get_group_path(group_uuid, product_groups, get_uuid=False):
-    def find_group_path(groups, target_uuid, current_path=[], current_uuid_path=[]):
-        for group in groups:
-            if group['id'] == target_uuid:
-                return (current_path + [group['name']], current_uuid_path + [group['id']])
-            if group.get('children'):
-                path = find_group_path(group['children'], target_uuid, 
-                                     current_path + [group['name']], 
-                                     current_uuid_path + [group['id']])
-                if path:
-                    return path
-        return None
-
-    path = find_group_path(product_groups, group_uuid)
-    if not path:
-        return '', []  # Возвращаем пустую строку и пустой список UUID
+def parse_manual_stock_settings(manual_stock_settings):
+    # Разбор и проверка настроек минимальных остатков из формы (final_manual_stock_groups):
+    # JSON-список [{"group_id": ..., "min_stock": ...}] -> словарь {UUID группы: минимальный остаток}
+    if not manual_stock_settings:
+        return {}
+    try:
+        settings = json.loads(manual_stock_settings)
+    except ValueError:
+        raise ValueError("Настройки минимальных остатков должны быть JSON-списком")
+    if not isinstance(settings, list):
+        raise ValueError("Настройки минимальных остатков должны быть JSON-списком")
     
-    names_path, uuid_path = path
-    return ('/'.join(names_path), uuid_path) if not get_uuid else ('/'.join(uuid_path), uuid_path)
+    min_stock_by_group = {}
+    for setting in settings:
+        try:
+            group_id = setting['group_id']
+            min_stock = int(setting['min_stock'])
+        except (TypeError, KeyError, ValueError):
+            raise ValueError(f"Некорректная настройка минимального остатка: {setting}")
+        if not group_id:
+            raise ValueError(f"Не указана группа для минимального остатка: {setting}")
+        # Для повторяющейся группы берем максимальное значение
+        if group_id not in min_stock_by_group or min_stock > min_stock_by_group[group_id]:
+            min_stock_by_group[group_id] = min_stock
+    return min_stock_by_group
+
+def get_manual_stock_by_group(manual_stock_settings, group_index):
+    # Настройки минимальных остатков разбираются один раз на отчет; ошибка в них не мешает построить отчет
+    try:
+        return resolve_manual_stock(parse_manual_stock_settings(manual_stock_settings), group_index)
+    except ValueError as e:
+        logger.warning(f"Ошибка при обработке настроек минимальных остатков: {str(e)}")
+        return {}
+
+def resolve_manual_stock(min_stock_by_group, group_index):
+    # Минимальный остаток для каждой группы дерева - максимум из настроек самой группы и всех ее предков,
+    # чтобы для товара это было одно обращение к словарю по его группе
+    resolved = {}
+    if not min_stock_by_group:
+        return resolved
+    # group_index заполняется обходом в глубину, поэтому родитель всегда обработан раньше потомков
+    for group_id, entry in group_index.items():
+        candidates = [value for value in (resolved.get(entry['parent']), min_stock_by_group.get(group_id)) if value is not None]
+        if candidates:
+            resolved[group_id] = max(candidates)
+    return resolved
 
 def get_sheet_name(products_data):
     # Получаем уникальные названи второго уровня
     level2_names = set()
     for product in products_data:
-        names_by_level = product['names_by_level']
+        names_by_level = product.names_by_level
         if len(names_by_level) > 1:  # Есл есь второй уровень
             level2_names.add(names_by_level[1])
     
@@ -447,268 +2332,567 @@ def get_sheet_name(products_data):
     # Если название пустое, используем значение по умолчанию 
     return sheet_name if sheet_name else "Отчет прибльности"
 
-def create_excel_report(data, store_id, end_date, planning_days, manual_stock_settings=None):
+# Общий пустой путь для товаров без группы
+EMPTY_PATH = ()
+# Результат расчета скорости продаж для товара без операций на складе
+NO_SALES_SPEED = (0, '', '', '', '')
+
+@dataclass(slots=True)
+class ProductRow:
+    # Товар отчета. uuid_path и names_by_level - общие для товаров одной группы списки из индекса групп
+    name: str
+    quantity: float
+    profit: float
+    sales_speeds: list
+    group_uuid: str
+    uuid_path: list
+    names_by_level: list
+    product_uuid: str
+    product_href: str
+
+def get_bulk_sales_speeds(store_ids, end_date, progress=None, token=None):
+    # Пакетная скорость продаж по каждому складу (см. get_sales_speeds), None - для складов, где она не удалась.
+    # Обороты складов загружаются по очереди, прогресс fetch_turnover - общий по всем складам
+    def store_progress(index, phase, done, total):
+        if phase == 'fetch_turnover':
+            done, total = (index * total + done, len(store_ids) * total) if total else (index + 1, len(store_ids))
+        progress(phase, done, total)
+
+    return [get_sales_speeds(store_id, end_date, partial(store_progress, index) if progress else None, token)
+            for index, store_id in enumerate(store_ids)]
+
+def build_products_data(data, store_id, end_date, bulk_turnover=True, progress=None, token=None):
+    # Товары отчета (ProductRow) со скоростью продаж на каждом складе (sales_speeds - в порядке складов),
+    # отсортированные по пути группы. store_id - склад или список складов.
+    # data - строки отчета {'meta', 'rows'} или итератор страниц (iter_report_pages): пакетная скорость продаж
+    # считается в фоне, пока загружаются страницы. Страницы, загруженные до ее готовности, ждут в waiting_pages
+    # (строки ReportRow), а после переводятся в товары сразу. Синхронизация оборотов обычно дольше загрузки
+    # отчета, поэтому в пике в памяти все строки отчета, но в виде ReportRow, а не разобранного JSON.
+    # Не зависит от срока планирования и ручных остатков, поэтому хранится в кэше результатов отчета
+    store_ids = [store_id] if isinstance(store_id, str) else list(store_id)
+    pages = [data] if isinstance(data, dict) else data
+    group_index = get_group_index()
+    products_data = []
+    
+    speeds_done = 0
+    speeds_total = 0
+    speeds_lock = threading.Lock()
+    # Товары страниц, переведенные во время загрузки, учитываются в прогрессе sales_speed после нее,
+    # чтобы фаза не чередовалась с загрузкой
+    pages_loaded = False
+    
+    def report_speed_progress(count):
+        nonlocal speeds_done
+        with speeds_lock:
+            speeds_done += count
+            done = speeds_done
+        if progress and pages_loaded:
+            progress('sales_speed', min(done, speeds_total), speeds_total)
+    
+    def fetch_speeds(rows, store):
+        # Запасной путь: скорость продаж по каждому товару страницы отдельным запросом
+        def fetch_speed(row):
+            check_cancelled(token)
+            speed = get_sales_speed(row.assortment_id, store, end_date, row.is_variant, token)
+            report_speed_progress(1)
+            return speed
+        with timed_phase('sales_speed', token):
+            return moysklad.map(fetch_speed, rows)
+    
+    def add_products(rows, bulk_speeds):
+        speeds_by_store = []
+        for store, store_speeds in zip(store_ids, bulk_speeds):
+            if store_speeds is None:
+                speeds_by_store.append(fetch_speeds(rows, store))
+            else:
+                # Товар без операций на складе - нулевая скорость, как у calculate_sales_speed без строк
+                speeds_by_store.append([store_speeds.get(row.assortment_id, NO_SALES_SPEED) for row in rows])
+                report_speed_progress(len(rows))
+        
+        # Собираем данные товаров с ненулевой скоростью продаж хотя бы на одном складе
+        for index, row in enumerate(rows):
+            speeds = [store_speeds[index] for store_speeds in speeds_by_store]
+            sales_speeds = [speed[0] for speed in speeds]
+            if not any(sales_speeds):
+                continue
+            # Группа и ссылка на товар - со склада, где были операции
+            _, group_uuid, group_name, product_uuid, product_href = next(speed for speed in speeds if speed[0] != 0)
+            # Пути группы не копируются в каждый товар: товары одной группы ссылаются на списки из индекса групп
+            group = group_index.get(group_uuid)
+            
+            products_data.append(ProductRow(
+                name=row.name,
+                quantity=row.sell_quantity,
+                profit=round(row.profit / 100, 2),
+                sales_speeds=sales_speeds,
+                group_uuid=group_uuid if group else '',
+                uuid_path=group['uuid_path'] if group else EMPTY_PATH,
+                names_by_level=group['name_path'] if group else EMPTY_PATH,
+                product_uuid=product_uuid,
+                product_href=product_href
+            ))
+    
+    # Пакетная скорость продаж всех складов считается в отдельном потоке одновременно с загрузкой страниц отчета;
+    # без пакетного режима скорость запрашивается по товарам каждой страницы сразу
+    speeds_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sales-speeds')
     try:
-        print("Начало создания Excel отчета")
-        print(f"Полученные настройки минимальных остатков: {manual_stock_settings}")  # Для отладки
+        bulk_future = None
+        bulk_speeds = [None] * len(store_ids)
+        if bulk_turnover:
+            bulk_future = speeds_executor.submit(get_bulk_sales_speeds, store_ids, end_date, progress, token)
+            bulk_speeds = None
+        waiting_pages = []
+        for page in pages:
+            check_cancelled(token)
+            if not speeds_total:
+                speeds_total = page.get('meta', {}).get('size', len(page['rows'])) * len(store_ids)
+            waiting_pages.append(page['rows'])
+            if bulk_speeds is None and bulk_future.done():
+                bulk_speeds = bulk_future.result()
+            if bulk_speeds is not None:
+                for rows in waiting_pages:
+                    add_products(rows, bulk_speeds)
+                waiting_pages.clear()
         
+        if bulk_speeds is None:
+            bulk_speeds = bulk_future.result()
+        pages_loaded = True
+        report_speed_progress(0)
+        for rows in waiting_pages:
+            add_products(rows, bulk_speeds)
+    finally:
+        # При ошибке или отмене не ждем фоновую синхронизацию: она сама остановится по token или допишет обороты
+        speeds_executor.shutdown(wait=False, cancel_futures=True)
+
+    # Сортируем данные по полному пути групп по возрастанию (путь строится один раз на группу)
+    group_paths = {}
+    def group_path(product):
+        path = group_paths.get(product.group_uuid)
+        if path is None:
+            path = group_paths[product.group_uuid] = '/'.join(product.names_by_level)
+        return path
+    products_data.sort(key=group_path)
+    return products_data
+
+def report_headers(max_depth, planning_days, store_names, report_store_count=1):
+    # Заголовок с учетом реальной глубины, начиная со второго уровня.
+    # Для нескольких складов скорость, прогноз и минимальный остаток выводятся по каждому складу.
+    # Отчет прибыльности загружается один раз по всем складам отчета (report_store_count), поэтому
+    # количество и прибыльность при нескольких складах - сумма по всем, в том числе на листе одного склада
+    group_level_headers = [f'Уровень {i+2}' for i in range(max_depth-1)] if max_depth > 1 else []
+    totals_suffix = ' (все склады)' if report_store_count > 1 else ''
+    headers = group_level_headers + [
+        'UUID',  # Изменено название стобц
+        'Наиноване', f'Количество{totals_suffix}', f'Прибыьность{totals_suffix}'
+    ]
+    if len(store_names) == 1:
+        return headers + ['Скорость продаж', f'Прогноз на {planning_days} дней', 'Минимальный остаток']
+    for store_name in store_names:
+        headers += [f'Скорость продаж ({store_name})', f'Прогноз на {planning_days} дней ({store_name})',
+                    f'Минимальный остаток ({store_name})']
+    return headers
+
+def get_unique_sheet_name(name, used_names):
+    # Название листа склада или группы: без запрещенных в Excel символов, не длиннее 31 символа и без повторов
+    base_name = re.sub(r'[\[\]:*?/\\]', ' ', name).strip() or "Отчет прибыльности"
+    sheet_name = base_name[:31]
+    suffix = 2
+    while sheet_name.lower() in used_names:
+        sheet_name = f"{base_name[:31 - len(str(suffix)) - 1]} {suffix}"
+        suffix += 1
+    used_names.add(sheet_name.lower())
+    return sheet_name
+
+def split_products_by_group(products_data, level):
+    # Товары по группам уровня level (1 - корневые) в порядке появления: [(названия пути группы, товары)].
+    # Товары из групп выше этого уровня - отдельной частью своей группы, товары без группы - частью с пустым путем
+    parts = {}
+    for product in products_data:
+        key = tuple(product.uuid_path[:level])
+        part = parts.get(key)
+        if part is None:
+            part = parts[key] = (product.names_by_level[:level], [])
+        part[1].append(product)
+    return list(parts.values())
+
+def build_report_sheets(products_data, store_ids, store_layout, planning_days, group_split='none'):
+    # Листы книги: один лист со столбцами всех складов или отдельный лист на каждый склад,
+    # при разбиении по группам (см. GROUP_SPLITS) - еще и отдельный лист на каждую группу
+    store_names_by_id = {store['id']: store['name'] for store in get_stores()}
+    store_names = [store_names_by_id.get(store_id, store_id) for store_id in store_ids]
+    
+    if len(store_ids) == 1 or store_layout != 'sheets':
+        sheets = [(get_sheet_name(products_data), products_data, store_names)]
+    else:
+        sheets = []
+        used_names = set()
+        for index, store_name in enumerate(store_names):
+            # На листе склада - только товары с продажами на этом складе
+            products = [replace(product, sales_speeds=[product.sales_speeds[index]])
+                        for product in products_data if product.sales_speeds[index] != 0]
+            sheets.append((get_unique_sheet_name(store_name, used_names), products, [store_name]))
+    
+    if group_split != 'none':
+        # Каждый лист делится на листы групп нужного уровня со своей глубиной групп и группировкой строк
+        level = GROUP_SPLITS.index(group_split)
+        used_names = set()
+        group_sheets = []
+        for title, products, names in sheets:
+            for group_names, group_products in split_products_by_group(products, level):
+                group_title = group_names[-1] if group_names else "Без группы"
+                if len(sheets) > 1:
+                    group_title = f"{group_title} ({title})"
+                group_sheets.append((get_unique_sheet_name(group_title, used_names), group_products, names))
+        sheets = group_sheets
+    
+    report_sheets = []
+    for title, products, names in sheets:
+        # Максимальная глубина групп по длине списка UUID. Столбец UUID стоит на месте max_depth, поэтому
+        # на листе только из товаров без группы (лист "Без группы") глубина все равно не меньше 1
+        max_depth = max(max((len(product.uuid_path) for product in products), default=0), 1)
+        logger.debug(f"Лист {title}: максимальная глубина групп {max_depth}")
+        report_sheets.append({
+            'title': title,
+            'products': products,
+            'max_depth': max_depth,
+            'store_count': len(names),
+            'headers': report_headers(max_depth, planning_days, names, len(store_ids))
+        })
+    return report_sheets
+
+def create_excel_report(data, store_id, end_date, planning_days, manual_stock_settings=None, bulk_turnover=True,
+                        progress=None, filename=None, token=None, streaming=EXCEL_STREAMING, products_data=None,
+                        store_layout='columns', group_split='none'):
+    # store_id - склад или список складов; store_layout - раскладка нескольких складов (см. STORE_LAYOUTS),
+    # group_split - разбиение на листы по группам (см. GROUP_SPLITS)
+    logger.info("Начало создания Excel отчета")
+    logger.debug(f"Полученные настройки минимальных остатков: {manual_stock_settings}")  # Для отладки
+    
+    store_ids = [store_id] if isinstance(store_id, str) else list(store_id)
+    group_index = get_group_index()
+    # Готовые данные товаров (из кэша результатов) используются как есть, без запросов к API
+    if products_data is None:
+        products_data = build_products_data(data, store_ids, end_date, bulk_turnover, progress, token)
+    
+    sheets = build_report_sheets(products_data, store_ids, store_layout, planning_days, group_split)
+    
+    manual_stock_by_group = get_manual_stock_by_group(manual_stock_settings, group_index)
+
+    if not filename:
+        # Без имени файла книга собирается в буфере (большая - во временном файле)
+        # и отдается в ответ напрямую, ничего не оставляя в рабочем каталоге
+        filename = tempfile.SpooledTemporaryFile(max_size=EXCEL_SPOOL_MAX_SIZE)
+    
+    if streaming:
+        return write_report_streaming(sheets, planning_days, manual_stock_by_group, filename, progress, token)
+    return write_report_in_memory(sheets, planning_days, manual_stock_by_group, filename, progress, token)
+
+def write_report_in_memory(sheets, planning_days, manual_stock_by_group, filename, progress=None, token=None):
+    wb = None
+    try:
         wb = Workbook()
-        ws = wb.active
-        
-        product_groups = get_product_groups()
-        products_data = []
-        max_depth = 0
+        total_products = sum(len(sheet['products']) for sheet in sheets)
+        product_number = 0
         
-        # Сначала собираем все данные и определяем максимальную глубину
-        for item in data['rows']:
-            check_if_cancelled()
-            assortment = item.get('assortment', {})
-            assortment_meta = assortment.get('meta', {})
-            assortment_href = assortment_meta.get('href', '')
+        for sheet_number, sheet in enumerate(sheets, start=1):
+            ws = wb.active if sheet_number == 1 else wb.create_sheet()
+            products_data = sheet['products']
+            headers = sheet['headers']
+            max_depth = sheet['max_depth']
             
-            is_variant = '/variant/' in assortment_href
-            variant_id = assortment_href.split('/variant/')[-1] if is_variant else assortment_href.split('/product/')[-1]
-            
-            if variant_id:
-                sales_speed, group_uuid, group_name, product_uuid, product_href = get_sales_speed(variant_id, store_id, end_date, is_variant)
-                if sales_speed != 0:
-                    full_path, uuid_path = get_group_path(group_uuid, product_groups)
-                    max_depth = max(max_depth, len(uuid_path))  # Используем длину списа UUID
-                    
-                    products_data.append({
-                        'name': assortment.get('name', ''),
-                        'quantity': item.get('sellQuantity', 0),
-                        'profit': round(item.get('profit', 0) / 100, 2),
-                        'sales_speed': sales_speed,
-                        'forecast': sales_speed * planning_days,
-                        'group_uuid': group_uuid,
-                        'group_path': full_path,
-                        'uuid_path': uuid_path,  # Сохраняем список UUID для правильного определения уровней
-                        'names_by_level': get_names_by_uuid(uuid_path, product_groups),
-                        'product_uuid': product_uuid,
-                        'product_href': product_href
-                    })
-
-        print(f"Максимальная глубина групп: {max_depth}")
-
-        # Сортируем данные по полному пути групп по возрастанию
-        products_data.sort(key=lambda x: x['group_path'])
-
-        # Формируем заголовк с учетом реальной глубины, начиная со вворого уровня
-        group_level_headers = [f'Уровень {i+2}' for i in range(max_depth-1)] if max_depth > 1 else []
-        headers = group_level_headers + [
-            'UUID',  # Изменено название стобц
-            'Наиноване', 'Количество', 'Прибыьность', 'Скорость продаж', 
-            f'Прогноз на {planning_days} дней', 'Минимальный остаток'
-        ]
-        
-        # Записываем заголовки
-        for col, header in enumerate(headers, start=1):
-            cell = ws.cell(row=1, column=col, value=header)
-            cell.font = Font(bold=True, color="FFFFFF")
-            cell.fill = PatternFill(start_color="000000", end_color="000000", fill_type="solid")
-
-        # Записываем данные с группами
-        current_row = 2
-        current_uuid_path = []
-        
-        def get_manual_stock_value(uuid_path):
-            if not manual_stock_settings:
-                return None
-                
-            try:
-                manual_settings = json.loads(manual_stock_settings)
-                print(f"Разобранные настройки: {manual_settings}")  # Для отладки
-                max_stock = None
+            with timed_phase('build_sheet', token):
+                # Записываем заголовки
+                for col, header in enumerate(headers, start=1):
+                    cell = ws.cell(row=1, column=col, value=header)
+                    cell.font = Font(bold=True, color="FFFFFF")
+                    cell.fill = PatternFill(start_color="000000", end_color="000000", fill_type="solid")
+
+                # Записываем данные с группами; уровень группировки задается каждой строке при записи
+                current_row = 2
+                for values, product, level in iter_report_rows(products_data, max_depth, planning_days,
+                                                               manual_stock_by_group, sheet['store_count']):
+                    if product is not None:
+                        product_number += 1
+                        check_cancelled(token)
+                        if progress:
+                            progress('build_sheet', product_number, total_products)
                 
-                # Проверяем каждую группу в пути товара
-                for group_uuid in uuid_path:
-                    for setting in manual_settings:
-                        if setting['group_id'] == group_uuid:
-                            setting_value = int(setting['min_stock'])
-                            print(f"Найдено значение {setting_value} для гуппы {group_uuid}")  # Для отладки
-                            # Сохраняем максимальное значение из всех подходящих групп
-                            if max_stock is None or setting_value > max_stock:
-                                max_stock = setting_value
+                    for col, value in enumerate(values, start=1):
+                        if value is not None:
+                            ws.cell(row=current_row, column=col, value=value)
                 
-                return max_stock
-            except Exception as e:
-                print(f"Ошибка при обработке настроек минимальных остатков: {str(e)}")
-                return None
-
-        # При записи данных продукта
-        for product in products_data:
-            uuid_path = product['uuid_path']
-            names_by_level = product['names_by_level']
-            
-            # Записываем строки групп, если путь изменился
-            for i, uuid in enumerate(uuid_path):
-                if i >= len(current_uuid_path) or uuid != current_uuid_path[i]:
-                    if i > 0:
-                        ws.cell(row=current_row, column=i, value=names_by_level[i])
-                    # Записываем UUID группы полностью
-                    uuid_cell = ws.cell(row=current_row, column=max_depth, value=uuid)
+                    uuid_cell = ws.cell(row=current_row, column=max_depth)
                     uuid_cell.alignment = Alignment(horizontal='left', shrink_to_fit=False)
+                    if product is not None and product.product_href:
+                        uuid_cell.hyperlink = product.product_href
+                        uuid_cell.font = Font(color="0000FF", underline="single")
+                
+                    if level:
+                        ws.row_dimensions[current_row].outline_level = level
                     current_row += 1
-            
-            # При запис UUID товара
-            uuid_cell = ws.cell(row=current_row, column=max_depth)
-            if product['product_href']:
-                uuid_cell.value = product['product_uuid']  # Записываем полный UUID
-                uuid_cell.hyperlink = product['product_href']
-                uuid_cell.font = Font(color="0000FF", underline="single")
-                uuid_cell.alignment = Alignment(horizontal='left', shrink_to_fit=False)
-            
-            ws.cell(row=current_row, column=max_depth+1, value=product['name'])
-            ws.cell(row=current_row, column=max_depth+2, value=product['quantity'])
-            ws.cell(row=current_row, column=max_depth+3, value=product['profit'])
-            ws.cell(row=current_row, column=max_depth+4, value=product['sales_speed'])
-            ws.cell(row=current_row, column=max_depth+5, value=product['forecast'])
-            
-            # Вычисляем автоматический минимальный остаток (округление вверх прогноза)
-            auto_min_stock = math.ceil(product['forecast'])
-            
-            # Получаем ручное значение минимального остатка для всей иерархии групп товара
-            manual_stock = get_manual_stock_value(product['uuid_path'])
-            # print(f"manual_stock: {manual_stock}")
-            # print(f"manual_stock_settings: {manual_stock_settings}")
-            
-            # Если есть ручное значение, сравниваем его с автоматическим и берем большее
-            min_stock_value = auto_min_stock  # По умолчанию используем автоматическое значение
-            if manual_stock is not None:
-                min_stock_value = max(auto_min_stock, manual_stock)
-            
-            # Записываем итоговое значение в ячейку
-            ws.cell(row=current_row, column=max_depth+6, value=min_stock_value)
-            
-            current_row += 1
-            current_uuid_path = uuid_path
-
-        # Обновляем диапазон таблицы с учетом реальной глубины
-        last_col = max_depth + 6  # Увеличиваем на 1, так как добавили новый столбец
-        table_ref = f"A1:{chr(64 + last_col)}{current_row-1}"
-        tab = Table(displayName="Table1", ref=table_ref)
-        style = TableStyleInfo(
-            name="TableStyleMedium9",
-            showFirstColumn=False,
-            showLastColumn=False,
-            showRowStripes=True,
-            showColumnStripes=False
-        )
-        tab.tableStyleInfo = style
-        ws.add_table(tab)
 
-        # После записи всех данных и перед форматированием добавляем группировку
-        ws.sheet_properties.outlinePr.summaryBelow = False  # Устанавливаем кнопку группировки сверху
+            # Обновляем диапазон таблицы с учетом реальной глубины и числа складов
+            last_col = len(headers)
+            table_ref = f"A1:{get_column_letter(last_col)}{current_row-1}"
+            tab = Table(displayName=f"Table{sheet_number}", ref=table_ref)
+            style = TableStyleInfo(
+                name="TableStyleMedium9",
+                showFirstColumn=False,
+                showLastColumn=False,
+                showRowStripes=True,
+                showColumnStripes=False
+            )
+            tab.tableStyleInfo = style
+            ws.add_table(tab)
 
-        # Функция для определения диапазонов групп
-        def find_groups(ws, start_row, end_row, max_depth):
-            groups = []  # [(start_row, end_row, level, group_name)]
+            # После записи всех данных и перед форматированием добавляем группировку
+            ws.sheet_properties.outlinePr.summaryBelow = False  # Устанавливаем кнопку группировки сверху
+
+            # Отключаем группировку для заголовка
+            ws.row_dimensions[1].outline_level = 0
             
-            # Проходим по каждой строке
-            for row in range(start_row, end_row + 1):
-                # Проверяем каждый уровень
-                for level in range(1, max_depth + 1):
-                    value = ws.cell(row=row, column=level).value
-                    if value is not None:
-                        # Находим конец группы (последнюю строку перед следующей группой того же или более высокого уровня)
-                        end_group_row = row
-                        for next_row in range(row + 1, end_row + 1):
-                            # Проверяем, не началась ли новая группа того же или более высокого уровня
-                            found_higher_level = False
-                            for check_level in range(1, level + 1):
-                                if ws.cell(row=next_row, column=check_level).value is not None:
-                                    found_higher_level = True
-                                    break
-                            if found_higher_level:
-                                end_group_row = next_row - 1
-                                break
-                            end_group_row = next_row
-                        
-                        groups.append((row, end_group_row, level, value))
+            # Форматирование
+            ws.freeze_panes = 'A2'
             
-            return groups
-
-        # Находим все группы
-        groups = find_groups(ws, 2, current_row - 1, max_depth)
-
-        # Сортируем групп по уровню (от большего к меньшему)
-        # и по позиции (сверху низ)
-        groups.sort(key=lambda x: (-x[2], x[0]))
-
-        # Применяем группировку
-        for start_row, end_row, level, group_name in groups:
-            if start_row < end_row:  # Группируем если есть что группировать
-                # Группируем все строки под группой
-                for row in range(start_row + 1, end_row + 1):
-                    current_level = ws.row_dimensions[row].outline_level
-                    ws.row_dimensions[row].outline_level = current_level + 1 if current_level is not None else 1
-                    ws.row_dimensions[row].hidden = False
-
-        # Отключаем группировку для заголовка
-        ws.row_dimensions[1].outline_level = 0
-        
-        # Форматирование
-        ws.freeze_panes = 'A2'
-        
-        # Автоподбор ширины столбцов
-        for column in ws.columns:
-            max_length = 0
-            column_letter = column[0].column_letter
-            
-            # Если это столбец "UUID" (max_depth)
-            if column[0].column == max_depth:
-                ws.column_dimensions[column_letter].width = 3
-                # Применяем настройки отображения ко всем ячейкам в столбце
-                for cell in column:
-                    if isinstance(cell.hyperlink, str):  # Если есть ссылка
-                        cell.font = Font(color="0000FF", underline="single")
-                    cell.alignment = Alignment(horizontal='left', shrink_to_fit=False)
-                continue
+            # Автоподбор ширины столбцов
+            for column in ws.columns:
+                max_length = 0
+                column_letter = column[0].column_letter
                 
-            for cell in column:
-                try:
-                    if len(str(cell.value)) > max_length:
-                        max_length = len(str(cell.value))
-                except:
-                    pass
-            adjusted_width = (max_length + 2)
-            ws.column_dimensions[column_letter].width = adjusted_width
+                # Если это столбец "UUID" (max_depth)
+                if column[0].column == max_depth:
+                    ws.column_dimensions[column_letter].width = 3
+                    # Применяем настройки отображения ко всем ячейкам в столбце
+                    for cell in column:
+                        if isinstance(cell.hyperlink, str):  # Если есть ссылка
+                            cell.font = Font(color="0000FF", underline="single")
+                        cell.alignment = Alignment(horizontal='left', shrink_to_fit=False)
+                    continue
+                    
+                for cell in column:
+                    try:
+                        if len(str(cell.value)) > max_length:
+                            max_length = len(str(cell.value))
+                    except:
+                        pass
+                adjusted_width = (max_length + 2)
+                ws.column_dimensions[column_letter].width = adjusted_width
 
-        # После сбора всех данных и перед созданием заголовков
-        sheet_name = get_sheet_name(products_data)
-        ws.title = sheet_name
-        print(f"Название листа: {sheet_name}")
+            ws.title = sheet['title']
+            logger.debug(f"Название листа: {ws.title}")
         
-        filename = f"report_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx"
-        
-        wb.save(filename)
+        with timed_phase('save', token):
+            wb.save(filename)
         wb.close()
+        if hasattr(filename, 'seek'):
+            filename.seek(0)
         return filename
         
-    except Exception as e:
-        if str(e) == "Processing cancelled by user":
-            abort(499, description="Processing cancelled by user")
-        raise e
     finally:
         try:
             wb.close()
         except:
             pass
 
-def get_names_by_uuid(uuid_path, product_groups):
-    def find_name_by_uuid(groups, target_uuid):
-        for group in groups:
-            if group['id'] == target_uuid:
-                return group['name']
-            if group.get('children'):
-                name = find_name_by_uuid(group['children'], target_uuid)
-                if name:
-                    return name
-        return None
+def outline_level(open_groups):
+    # Уровень группировки строки по числу открытых над ней групп.
+    # Корневая группа не сворачивается: столбцы уровней в отчете начинаются со второго уровня
+    return max(len(open_groups) - 1, 0)
+
+def iter_report_rows(products_data, max_depth, planning_days, manual_stock_by_group, store_count=1):
+    # Строки листа в порядке вывода: (значения по столбцам, товар или None для строки группы, уровень группировки).
+    # Та же раскладка, что при записи в обычную книгу: имя уровня в столбце уровня, UUID в столбце max_depth,
+    # затем по три столбца (скорость, прогноз, минимальный остаток) на каждый из store_count складов.
+    # Уровни считаются за один проход по отсортированным путям: стек открытых групп - общий префикс
+    # путей соседних товаров, остальные группы закрываются, новые открываются строками групп
+    last_col = max_depth + 3 + 3 * store_count
+    open_groups = []
+    
+    for product in products_data:
+        uuid_path = product.uuid_path
+        names_by_level = product.names_by_level
+        
+        common = 0
+        while common < len(open_groups) and common < len(uuid_path) and open_groups[common] == uuid_path[common]:
+            common += 1
+        del open_groups[common:]
+        
+        # Строки групп, которые открываются на пути товара
+        for i in range(common, len(uuid_path)):
+            values = [None] * last_col
+            if i > 0:
+                values[i - 1] = names_by_level[i]
+            values[max_depth - 1] = uuid_path[i]
+            yield values, None, outline_level(open_groups)
+            open_groups.append(uuid_path[i])
+        
+        values = [None] * last_col
+        if product.product_href:
+            values[max_depth - 1] = product.product_uuid
+        values[max_depth] = product.name
+        values[max_depth + 1] = product.quantity
+        values[max_depth + 2] = product.profit
+        
+        # Ручное значение минимального остатка для групп товара - общее для всех складов
+        manual_stock = manual_stock_by_group.get(uuid_path[-1]) if uuid_path else None
+        for store_index, sales_speed in enumerate(product.sales_speeds):
+            col = max_depth + 3 + 3 * store_index
+            forecast = sales_speed * planning_days
+            values[col] = sales_speed
+            values[col + 1] = forecast
+            
+            # Минимальный остаток: прогноз с округлением вверх, но не ниже ручного значения для групп товара
+            min_stock_value = math.ceil(forecast)
+            if manual_stock is not None:
+                min_stock_value = max(min_stock_value, manual_stock)
+            values[col + 2] = min_stock_value
+        
+        yield values, product, outline_level(open_groups)
+
+def iter_export_rows(products_data, max_depth, planning_days, manual_stock_by_group, store_count=1):
+    # Строки товаров для выгрузки без оформления (CSV, Parquet, JSON): те же столбцы, что на листе книги,
+    # но без строк групп - названия уровней групп проставляются в строке каждого товара
+    for values, product, _ in iter_report_rows(products_data, max_depth, planning_days, manual_stock_by_group,
+                                               store_count):
+        if product is None:
+            continue
+        names_by_level = product.names_by_level
+        for i in range(1, len(names_by_level)):
+            values[i - 1] = names_by_level[i]
+        yield values
+
+def write_report_streaming(sheets, planning_days, manual_stock_by_group, filename, progress=None, token=None):
+    # Потоковая запись: ширины столбцов каждого листа считаются заранее по его товарам,
+    # затем строки вместе с уровнями группировки пишутся в write_only книгу один раз и по порядку
+    build_started = time.perf_counter()
+    total_products = sum(len(sheet['products']) for sheet in sheets)
+    product_number = 0
+    
+    header_font = Font(bold=True, color="FFFFFF")
+    header_fill = PatternFill(start_color="000000", end_color="000000", fill_type="solid")
+    link_font = Font(color="0000FF", underline="single")
+    uuid_alignment = Alignment(horizontal='left', shrink_to_fit=False)
+    
+    wb = Workbook(write_only=True)
+    try:
+        for sheet_number, sheet in enumerate(sheets, start=1):
+            products_data = sheet['products']
+            headers = sheet['headers']
+            max_depth = sheet['max_depth']
+            last_col = len(headers)
+            uuid_col = max_depth
+            
+            def sheet_rows():
+                return iter_report_rows(products_data, max_depth, planning_days, manual_stock_by_group,
+                                        sheet['store_count'])
+            
+            # Предварительный проход: ширина столбцов (пустая ячейка считается как 'None', как в автоподборе)
+            # и число строк для диапазона таблицы
+            widths = [len(str(header)) for header in headers]
+            last_row = 1
+            for values, _, _ in sheet_rows():
+                for col, value in enumerate(values):
+                    widths[col] = max(widths[col], len(str(value)))
+                last_row += 1
+            
+            ws = wb.create_sheet(title=sheet['title'])
+            logger.debug(f"Название листа: {ws.title}")
+            
+            # Настройки листа и столбцов задаются до записи строк
+            ws.sheet_properties.outlinePr.summaryBelow = False  # Устанавливаем кнопку группировки сверху
+            ws.freeze_panes = 'A2'
+            for col in range(1, last_col + 1):
+                ws.column_dimensions[get_column_letter(col)].width = 3 if col == uuid_col else widths[col - 1] + 2
+            
+            tab = Table(displayName=f"Table{sheet_number}", ref=f"A1:{get_column_letter(last_col)}{last_row}")
+            tab.tableStyleInfo = TableStyleInfo(
+                name="TableStyleMedium9",
+                showFirstColumn=False,
+                showLastColumn=False,
+                showRowStripes=True,
+                showColumnStripes=False
+            )
+            # В write_only режиме заголовки таблицы не читаются из ячеек - задаем их явно
+            tab._initialise_columns()
+            for column, header in zip(tab.tableColumns, headers):
+                column.name = header
+            with warnings.catch_warnings():
+                # openpyxl всегда предупреждает о столбцах таблицы в write_only режиме, а мы их уже задали
+                warnings.simplefilter('ignore', UserWarning)
+                ws.add_table(tab)
+            
+            header_row = []
+            for col, header in enumerate(headers, start=1):
+                cell = WriteOnlyCell(ws, value=header)
+                cell.font = header_font
+                cell.fill = header_fill
+                if col == uuid_col:
+                    cell.alignment = uuid_alignment
+                header_row.append(cell)
+            ws.append(header_row)
+            
+            row_idx = 2
+            for values, product, level in sheet_rows():
+                if product is not None:
+                    product_number += 1
+                    check_cancelled(token)
+                    if progress:
+                        progress('build_sheet', product_number, total_products)
+                
+                uuid_cell = WriteOnlyCell(ws, value=values[uuid_col - 1])
+                uuid_cell.alignment = uuid_alignment
+                if product is not None and product.product_href:
+                    uuid_cell.hyperlink = product.product_href
+                    uuid_cell.font = link_font
+                values[uuid_col - 1] = uuid_cell
+                
+                # Уровень группировки задается перед записью строки и сразу удаляется, чтобы не копить память
+                if level:
+                    ws.row_dimensions[row_idx].outline_level = level
+                ws.append(values)
+                if level:
+                    del ws.row_dimensions[row_idx]
+                row_idx += 1
+        record_phase('build_sheet', time.perf_counter() - build_started, token)
+        
+        with timed_phase('save', token):
+            wb.save(filename)
+        if hasattr(filename, 'seek'):
+            filename.seek(0)
+        return filename
+    finally:
+        # При отмене посреди листа дописываем его, иначе генератор строк листа остается с закрытым файлом
+        for ws in wb.worksheets:
+            if not ws.closed:
+                try:
+                    ws.close()
+                except Exception:
+                    pass
+        wb.close()
+
+def warm_up():
+    # Прогрев справочников при запуске, чтобы первый пользователь не ждал загрузки складов и дерева групп.
+    # С общим кэшем справочников в API идет только первый запущенный воркер, остальные читают базу
+    try:
+        get_stores()
+        get_group_index()
+    except Exception as e:
+        logger.warning(f"Не удалось загрузить справочники при запуске: {str(e)}")
 
-    return [find_name_by_uuid(product_groups, uuid) or '' for uuid in uuid_path]
+def create_app():
+    # Приложение для WSGI-сервера с несколькими воркерами (см. wsgi.py), вызывается в каждом воркере:
+    # прогрев справочников, возобновление прерванных заданий, которые не выполняет другой воркер,
+    # плановое обновление оборотов и расписание постоянных отчетов (в одном из воркеров)
+    warm_up()
+    resume_unfinished_jobs()
+    start_turnover_refresh()
+    start_standing_reports()
+    return app
 
 if __name__ == '__main__':
-    print("Starting Flask app...")
+    logger.info("Starting Flask app...")
+    # Режим разработки: один процесс с отладчиком. С reloader модуль выполняется дважды -
+    # прогрев и задания только в рабочем процессе
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        create_app()
     app.run(debug=True, port=5000)
@@ -0,0 +1,320 @@
+import os
+import io
+import sys
+import json
+import time
+import uuid
+import random
+import argparse
+import tempfile
+import threading
+from datetime import datetime, timedelta
+from urllib.parse import urlsplit, unquote
+
+import requests
+from requests.adapters import BaseAdapter
+
+# Офлайн-замер формирования отчета: вместо API МойСклад запросы обслуживает FakeMoySklad -
+# транспорт requests, подключенный к сессии клиента app.moysklad. Данные генерируются по параметрам
+# (число товаров, глубина дерева групп, операции на товар), задержка ответа задается в миллисекундах.
+#
+#   python benchmark.py --variants 10000 --depth 6 --latency-ms 50
+#
+# Модуль app при импорте берет токен из MOYSKLAD_TOKEN или config.py рядом с app.py (для замера подойдет любой).
+
+import app
+
+OPERATION_TYPES = ('supply', 'retaildemand', 'demand', 'move', 'loss')
+
+
+class FakeMoySklad(BaseAdapter):
+    # Ответы на /entity/store, /entity/productfolder, /report/profit/byvariant и /report/turnover/byoperations
+    # с постраничной выдачей (limit/offset) и фильтрами store, productFolder, variant/product, momentFrom/momentTo
+    def __init__(self, variants=1000, depth=6, branching=3, stores=3, operations_per_variant=20,
+                 latency=0.0, seed=1, history_start=app.SALES_HISTORY_START):
+        super().__init__()
+        self.latency = latency
+        self.rng = random.Random(seed)
+        self.requests = 0
+        self.lock = threading.Lock()
+        self.last_query_key = None
+        self.last_rows = None
+
+        self.stores = [{'id': self._uuid(), 'name': f"Склад {i + 1}"} for i in range(stores)]
+        self.folders = []
+        self.folder_paths = {}
+        self._build_folders(depth, branching)
+
+        leaves = [folder for folder in self.folders if folder['leaf']]
+        self.variants = []
+        for i in range(variants):
+            folder = self.rng.choice(leaves)
+            self.variants.append({'id': self._uuid(), 'name': f"Товар {i + 1}", 'folder': folder})
+
+        self.operations = self._build_operations(operations_per_variant, history_start)
+
+    def _uuid(self):
+        return str(uuid.UUID(int=self.rng.getrandbits(128), version=4))
+
+    def _build_folders(self, depth, branching):
+        level = [None]
+        for current_depth in range(1, depth + 1):
+            next_level = []
+            for parent in level:
+                # Один корень, ниже - branching подгрупп на уровень
+                for i in range(1 if parent is None else branching):
+                    folder = {
+                        'id': self._uuid(),
+                        'name': f"Группа {current_depth}.{len(next_level) + 1}",
+                        'parent': parent,
+                        'leaf': current_depth == depth
+                    }
+                    self.folders.append(folder)
+                    parent_path = self.folder_paths[parent['id']] if parent else []
+                    self.folder_paths[folder['id']] = parent_path + [folder['id']]
+                    next_level.append(folder)
+            level = next_level
+
+    def _build_operations(self, operations_per_variant, history_start):
+        start = datetime.strptime(history_start, '%Y-%m-%d %H:%M:%S')
+        span = (datetime.now() - start).total_seconds()
+        operations = []
+        for store in self.stores:
+            for variant in self.variants:
+                for _ in range(operations_per_variant):
+                    moment = start + timedelta(seconds=self.rng.uniform(0, span))
+                    operation_type = self.rng.choice(OPERATION_TYPES)
+                    quantity = self.rng.randint(5, 50) if operation_type == 'supply' else -self.rng.randint(1, 5)
+                    operations.append((store['id'], variant, moment.strftime('%Y-%m-%d %H:%M:%S.000'),
+                                       quantity, operation_type))
+        operations.sort(key=lambda operation: operation[2])
+        return operations
+
+    def _href(self, entity, entity_id):
+        return f"{app.BASE_URL}/entity/{entity}/{entity_id}"
+
+    @staticmethod
+    def _parse_query(query):
+        # Параметры и фильтры в том виде, как их собирает build_query_url: filter=<поле>=<href>
+        params, filters = {}, []
+        for part in query.split('&'):
+            if not part:
+                continue
+            key, _, value = part.partition('=')
+            value = unquote(value)
+            if key == 'filter':
+                field, _, filter_value = value.partition('=')
+                filters.append((field, filter_value.split('/')[-1]))
+            else:
+                params[key] = value
+        return params, filters
+
+    def _stores(self, params, filters):
+        return [{'id': store['id'], 'name': store['name'], 'meta': {'href': self._href('store', store['id'])}}
+                for store in self.stores]
+
+    def _productfolders(self, params, filters):
+        rows = []
+        for folder in self.folders:
+            row = {'id': folder['id'], 'name': folder['name'], 'meta': {'href': self._href('productfolder', folder['id'])}}
+            if folder['parent']:
+                row['productFolder'] = {'meta': {'href': self._href('productfolder', folder['parent']['id'])}}
+            rows.append(row)
+        return rows
+
+    def _in_folders(self, variant, folder_ids):
+        return not folder_ids or any(folder_id in self.folder_paths[variant['folder']['id']] for folder_id in folder_ids)
+
+    def _profit(self, params, filters):
+        folder_ids = [value for field, value in filters if field == 'productFolder']
+        rows = []
+        for variant in self.variants:
+            if not self._in_folders(variant, folder_ids):
+                continue
+            rows.append({
+                'assortment': {'name': variant['name'], 'meta': {'href': self._href('variant', variant['id'])}},
+                'sellQuantity': self.rng.randint(1, 100),
+                'profit': self.rng.randint(-10000, 100000)
+            })
+        return rows
+
+    def _turnover(self, params, filters):
+        store_ids = {value for field, value in filters if field == 'store'}
+        assortment_ids = {value for field, value in filters if field in ('variant', 'product')}
+        moment_from = params.get('momentFrom', '')
+        moment_to = params.get('momentTo', '9999') + '.999'
+        rows = []
+        for store_id, variant, moment, quantity, operation_type in self.operations:
+            if moment < moment_from or moment > moment_to:
+                continue
+            if store_ids and store_id not in store_ids:
+                continue
+            if assortment_ids and variant['id'] not in assortment_ids:
+                continue
+            folder = variant['folder']
+            rows.append({
+                'assortment': {
+                    'name': variant['name'],
+                    'meta': {'href': self._href('variant', variant['id']),
+                             'uuidHref': f"https://online.moysklad.ru/app/#good/edit?id={variant['id']}"},
+                    'productFolder': {'meta': {'href': self._href('productfolder', folder['id'])}, 'name': folder['name']}
+                },
+                'quantity': quantity,
+                'operation': {'moment': moment, 'meta': {'type': operation_type}}
+            })
+        return rows
+
+    ROUTES = {
+        '/entity/store': '_stores',
+        '/entity/productfolder': '_productfolders',
+        '/report/profit/byvariant': '_profit',
+        '/report/turnover/byoperations': '_turnover'
+    }
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        with self.lock:
+            self.requests += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+        url = urlsplit(request.url)
+        path = url.path[len(app.API_PATH):] if url.path.startswith(app.API_PATH) else url.path
+        params, filters = self._parse_query(url.query)
+
+        handler = self.ROUTES.get(path)
+        if handler is None:
+            return self._response(request, 404, {'errors': [{'error': f"Неизвестный путь {path}"}]})
+
+        limit = int(params.get('limit', 1000))
+        offset = int(params.get('offset', 0))
+        # Все страницы одного запроса режутся из одного набора строк, чтобы замер не мерил сам генератор
+        query_key = (path, tuple(sorted((k, v) for k, v in params.items() if k not in ('limit', 'offset'))), tuple(filters))
+        with self.lock:
+            if query_key != self.last_query_key:
+                self.last_query_key = query_key
+                self.last_rows = getattr(self, handler)(params, filters)
+            rows = self.last_rows
+        return self._response(request, 200, {
+            'meta': {'size': len(rows), 'limit': limit, 'offset': offset},
+            'rows': rows[offset:offset + limit]
+        })
+
+    def _response(self, request, status_code, payload):
+        response = requests.Response()
+        response.status_code = status_code
+        response.headers['Content-Type'] = 'application/json;charset=utf-8'
+        response.raw = io.BytesIO(json.dumps(payload, ensure_ascii=False).encode('utf-8'))
+        response.url = request.url
+        response.request = request
+        return response
+
+    def close(self):
+        pass
+
+
+def timed(results, name, fn, *args, **kwargs):
+    started = time.perf_counter()
+    value = fn(*args, **kwargs)
+    results[name] = round(time.perf_counter() - started, 3)
+    return value
+
+
+def run_report(fake, store_id, end_date, planning_days, workdir, label):
+    # Один прогон отчета: get_report_data -> build_products_data -> create_excel_report с метриками этапов
+    token = app.CancelToken()
+    requests_before = fake.requests
+    results = {}
+    started = time.perf_counter()
+
+    data = timed(results, 'get_report_data', app.get_report_data, '2024-01-01', end_date, store_id, [], token=token)
+    products_data = timed(results, 'build_products_data', app.build_products_data, data, store_id, end_date, token=token)
+    filename = os.path.join(workdir, f"{label}.xlsx")
+    timed(results, 'create_excel_report', app.create_excel_report, data, store_id, end_date, planning_days,
+          filename=filename, token=token, products_data=products_data)
+
+    results['total'] = round(time.perf_counter() - started, 3)
+    results['api_requests'] = fake.requests - requests_before
+    results['rows'] = len(data['rows'])
+    results['products'] = len(products_data)
+    results['file_bytes'] = os.path.getsize(filename)
+    results['metrics'] = token.metrics.snapshot()
+    return results
+
+
+def run_benchmark(args):
+    fake = FakeMoySklad(variants=args.variants, depth=args.depth, branching=args.branching, stores=args.stores,
+                        operations_per_variant=args.operations, latency=args.latency_ms / 1000, seed=args.seed)
+    app.moysklad.session.mount('https://', fake)
+
+    workdir = tempfile.mkdtemp(prefix='analyse-bench-')
+    # Кэши и хранилище оборотов - во временном каталоге, чтобы замер не зависел от рабочих данных
+    app.reference_cache = app.ReferenceCache(app.REFERENCE_CACHE_TTL)
+    app.turnover_store = app.TurnoverStore(os.path.join(workdir, 'turnover.sqlite3'))
+    app.report_cache.invalidate()
+
+    store_id = fake.stores[0]['id']
+    end_date = datetime.now().strftime('%Y-%m-%d')
+    results = {
+        'params': vars(args),
+        'operations': len(fake.operations),
+        'folders': len(fake.folders)
+    }
+
+    # Холодный прогон: пустой кэш справочников и полная загрузка истории операций
+    results['cold'] = run_report(fake, store_id, end_date, args.planning_days, workdir, 'cold')
+    # Повторный прогон: справочники из кэша, из оборотов догружается только последний период
+    results['warm'] = run_report(fake, store_id, end_date, args.planning_days, workdir, 'warm')
+
+    # Запрос оборотов по одному товару (запасной путь без пакетной загрузки) на выборке товаров
+    sample = fake.variants[:args.speed_sample]
+    started = time.perf_counter()
+    for variant in sample:
+        app.get_sales_speed(variant['id'], store_id, end_date, True)
+    elapsed = time.perf_counter() - started
+    results['get_sales_speed'] = {
+        'variants': len(sample),
+        'seconds': round(elapsed, 3),
+        'per_variant': round(elapsed / len(sample), 4) if sample else None
+    }
+    return results
+
+
+def print_summary(results):
+    print(f"Операций: {results['operations']}, групп: {results['folders']}")
+    for label in ('cold', 'warm'):
+        run = results[label]
+        print(f"\n{label}: {run['total']} с, запросов к API: {run['api_requests']}, "
+              f"строк: {run['rows']}, товаров в отчете: {run['products']}")
+        for name in ('get_report_data', 'build_products_data', 'create_excel_report'):
+            print(f"  {name:<22} {run[name]:>8} с")
+        for phase, stats in run['metrics']['phases'].items():
+            print(f"  этап {phase:<17} {stats['seconds']:>8} с")
+    speed = results['get_sales_speed']
+    print(f"\nget_sales_speed по одному товару: {speed['variants']} товаров за {speed['seconds']} с "
+          f"({speed['per_variant']} с на товар)")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Офлайн-замер формирования отчета на сгенерированных данных МойСклад")
+    parser.add_argument('--variants', type=int, default=10000, help="число товаров/модификаций")
+    parser.add_argument('--depth', type=int, default=6, help="глубина дерева групп")
+    parser.add_argument('--branching', type=int, default=3, help="подгрупп на каждом уровне")
+    parser.add_argument('--stores', type=int, default=1, help="число складов")
+    parser.add_argument('--operations', type=int, default=20, help="операций на товар на каждом складе")
+    parser.add_argument('--latency-ms', type=float, default=50, help="задержка каждого ответа API, мс")
+    parser.add_argument('--planning-days', type=int, default=30)
+    parser.add_argument('--speed-sample', type=int, default=20, help="товаров для замера get_sales_speed")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help="сохранить результаты в JSON для сравнения между версиями")
+    args = parser.parse_args(argv)
+
+    results = run_benchmark(args)
+    print_summary(results)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,10 @@
+# Точка входа для WSGI-сервера с несколькими воркерами, например:
+#
+#   gunicorn -w 4 -b 0.0.0.0:5000 --timeout 600 wsgi:app
+#
+# Без --preload: пулы потоков клиента МойСклад и заданий создаются в каждом воркере.
+# Справочники, задания и обороты хранятся в SQLite в ANALYSE_DATA_DIR (по умолчанию - каталог приложения)
+# и общие для всех воркеров; токен - из переменной окружения MOYSKLAD_TOKEN или config.py.
+from app import create_app
+
+app = create_app()